@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of dux-ghl-contacts-integration.py. A local HTTP stub replays the DUX
+(/sucursales, /facturas, /clientes) and GHL (/contacts/search, /contacts/upsert, PUT /contacts/{id})
+endpoints with configurable latency and injected 429s, and a fake WebDriver serves synthetic client
+grids. Every scenario runs in a fresh subprocess with its own state directory and reports wall time,
+request counts and peak memory. The sheets_writer scenario checks the Google Sheets writers of
+main.py against an in-memory worksheet.
+
+    python benchmark.py --scenarios main,upsert_contacts,search_invoices --sizes 100,1000 --latency 0.02
+    python benchmark.py --scenarios sheets_writer --sizes 1000
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+
+import dux_browser
+from metrics import normalize_endpoint
+from sheets_writer import FakeWorksheet, SheetUpsertWriter, SheetWriter
+
+SCENARIOS = ("main", "upsert_contacts", "search_invoices", "payload_mapping", "sheets_writer")
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dux-ghl-contacts-integration.py")
+CLIENT_ID_START = 100000
+
+
+def make_client_row(number):
+    """
+    Synthetic client in csv_clients_dictionary layout
+    """
+    return [
+        str(CLIENT_ID_START + number), "01/01/2024", f"CLIENTE {number}", "CONSUMIDOR FINAL", "DNI",
+        str(20000000 + number), "", "", "MINORISTA", "", "NO", "", "FACTURA B", "LISTA 1", "SI",
+        f"FANTASIA {number}", "1000", f"cliente{number}@example.com", "VENDEDOR 1", "BUENOS AIRES",
+        "CABA", "CENTRO", f"CALLE {number}", f"+54 11 {4000000 + number}", "", "ZONA 1", "CONTADO",
+    ]
+
+
+def make_invoice(branch, number, client_count):
+    """
+    Synthetic /facturas result for a random client, one every 7 minutes from January 1st 2024
+    """
+    issued_at = datetime(2024, 1, 1, 9) + timedelta(minutes=number * 7)
+    return {
+        "id": branch * 10_000_000 + number,
+        "id_cliente": CLIENT_ID_START + random.randrange(client_count),
+        "fecha_comp": issued_at.strftime("%b %d, %Y %I:%M:%S %p"),
+        "nro_pto_vta": branch,
+        "id_personal": 1,
+        "id_vendedor": 1,
+        "tipo_comp": "FACTURA_B",
+        "nro_comp": number,
+        "monto_gravado": 1000.0,
+        "total": 1210.0,
+        "detalles_cobro": [{"monto": 1210.0}] if number % 2 else [],
+        "presupuesto": [],
+        "detalles": [{"item": "COMODATO DISPENSER" if number % 5 == 0 else "BIDON 20L"} for _ in range(3)],
+    }
+
+
+class StubData:
+    """
+    Fixtures served by the stub and the request counters of the current scenario
+    """
+
+    def __init__(self, latency=0.0, rate_429=0.0, branches=3):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.branches = [{"id": branch, "sucursal": f"SUCURSAL {branch}"} for branch in range(1, branches + 1)]
+        self.clients = []
+        self.invoices = {}
+        self.requests = Counter()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def load(self, client_count, invoice_count):
+        random.seed(client_count)
+        self.clients = [make_client_row(number) for number in range(client_count)]
+        self.invoices = {branch["id"]: [] for branch in self.branches}
+        for number in range(invoice_count):
+            branch = self.branches[number % len(self.branches)]["id"]
+            self.invoices[branch].append(make_invoice(branch, number, max(1, client_count)))
+        with self.lock:
+            self.requests = Counter()
+            self.throttled = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes, without this every response waits for a delayed ACK
+    disable_nagle_algorithm = True
+    data = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PUT(self):
+        self.handle_api("PUT")
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_api(self, method):
+        data = self.data
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        endpoint = normalize_endpoint(url.path)
+
+        if data.latency:
+            time.sleep(data.latency)
+        with data.lock:
+            data.requests[f"{method} {endpoint}"] += 1
+            throttled = random.random() < data.rate_429
+            if throttled:
+                data.throttled += 1
+        if throttled:
+            self.send_json(429, {"message": "Too many requests"}, {"Retry-After": "0"})
+            return
+
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 50))
+        if url.path.endswith("/sucursales"):
+            self.send_json(200, data.branches)
+        elif url.path.endswith("/facturas"):
+            invoices = data.invoices.get(int(query.get("idSucursal", 0)), [])
+            self.send_json(200, {"results": invoices[offset:offset + limit], "total": len(invoices)})
+        elif url.path.endswith("/clientes"):
+            clients = [{"id_cliente": row[0], "cliente": row[2], "email": row[17], "telefono": row[23]}
+                       for row in data.clients[offset:offset + limit]]
+            self.send_json(200, {"results": clients, "total": len(data.clients)})
+        elif url.path == "/contacts/upsert":
+            id_cliente_dux = next((field.get("field_value") for field in body.get("customFields", [])
+                                   if field.get("key") == "id_cliente_dux"), "")
+            self.send_json(200, {"new": True, "contact": {"id": f"ghl{id_cliente_dux}"}})
+        elif url.path.endswith("/customFields"):
+            self.send_json(200, {"customFields": [{"id": "cf-id-cliente-dux", "fieldKey": "contact.id_cliente_dux"}]})
+        elif url.path == "/contacts/search" and "group" in body["filters"][0]:
+            id_cliente_dux = body["filters"][0]["filters"][0]["value"]
+            self.send_json(200, {"contacts": [{"id": f"ghl{id_cliente_dux}"}], "total": 1})
+        elif url.path == "/contacts/search":
+            # Contact index preload: every client has a contact, paged by page number or searchAfter
+            page_limit = body.get("pageLimit", 20)
+            start = body["searchAfter"][0] + 1 if body.get("searchAfter") else (body.get("page", 1) - 1) * page_limit
+            contacts = [{"id": f"ghl{row[0]}", "customFields": [{"id": "cf-id-cliente-dux", "value": row[0]}],
+                         "dateUpdated": "2024-01-01T00:00:00.000Z", "searchAfter": [position]}
+                        for position, row in enumerate(data.clients[start:start + page_limit], start=start)]
+            self.send_json(200, {"contacts": contacts, "total": len(data.clients)})
+        elif method == "PUT" and url.path.startswith("/contacts/"):
+            self.send_json(200, {"succeded": True})
+        else:
+            self.send_json(404, {"message": f"No stub for {method} {url.path}"})
+
+
+class FakeElement:
+    """
+    WebElement stand-in; raises StaleElementReferenceException once the page replaced it
+    """
+
+    def __init__(self, element_id="", classes="", on_click=None, on_keys=None):
+        self.element_id = element_id
+        self.classes = classes
+        self.on_click = on_click
+        self.on_keys = on_keys
+        self.rows = []
+        self.stale = False
+
+    def check_attached(self):
+        if self.stale:
+            raise StaleElementReferenceException(f"Element {self.element_id or self.classes} is stale")
+
+    def is_displayed(self):
+        self.check_attached()
+        return True
+
+    def is_enabled(self):
+        self.check_attached()
+        return True
+
+    def get_attribute(self, name):
+        self.check_attached()
+        return {"id": self.element_id, "class": self.classes}.get(name)
+
+    def find_elements(self, by, value):
+        self.check_attached()
+        return list(self.rows)
+
+    def click(self):
+        self.check_attached()
+        if self.on_click:
+            self.on_click()
+
+    def send_keys(self, *keys):
+        self.check_attached()
+        if self.on_keys:
+            self.on_keys("".join(keys))
+
+
+class FakeDriver:
+    """
+    WebDriver stand-in for the DUX login, branch selection, date filter and a clients grid of
+    `pages` pages of `rows` rows (the last page holds the remainder), with optional page latency
+    """
+
+    def __init__(self, client_rows, rows_per_page=50, page_latency=0.0):
+        self.client_rows = client_rows
+        self.rows_per_page = rows_per_page
+        self.page_latency = page_latency
+        self.page_count = max(1, math.ceil(len(client_rows) / rows_per_page))
+        self.page = 0
+        self.logged_in = False
+        self.current_url = "about:blank"
+        self.title = "DUX"
+        self.table_body = FakeElement(classes="ui-datatable-data")
+        self.table_body.rows = [FakeElement(classes="ui-widget-content")]
+        self.branch_button = FakeElement("formInicio:j_idt910", on_click=self.select_branch)
+
+        password = FakeElement("formLogin:inputPassword", on_keys=self.submit_login)
+        date_to = FakeElement("formCabecera:j_idt1047_input", on_keys=self.submit_date_filter)
+        # Answers to the first (known id) locator of every element in the selector registry
+        self.elements = {
+            (By.ID, "formLogin:inputUsuario"): FakeElement("formLogin:inputUsuario"),
+            (By.ID, "formLogin:inputPassword"): password,
+            dux_browser.SELECTORS["date_filter_menu"][0]: FakeElement("formCabecera:j_idt1031_label"),
+            dux_browser.SELECTORS["date_filter_range_option"][0]: FakeElement("formCabecera:j_idt1031_3"),
+            dux_browser.SELECTORS["date_from_input"][0]: FakeElement("formCabecera:j_idt1041_input"),
+            dux_browser.SELECTORS["date_to_input"][0]: date_to,
+        }
+
+    def get(self, url):
+        self.current_url = url
+
+    def quit(self):
+        pass
+
+    def get_cookies(self):
+        return []
+
+    def execute_cdp_cmd(self, command, arguments):
+        return {}
+
+    def execute_script(self, script, *args):
+        if script == dux_browser.EXTRACT_TABLE_SCRIPT:
+            start = self.page * self.rows_per_page
+            return [["", ""] + row for row in self.client_rows[start:start + self.rows_per_page]]
+        if script == dux_browser.AJAX_IDLE_SCRIPT:
+            return True
+        return []
+
+    def find_elements(self, by, value):
+        if value.startswith("formLogin:"):
+            return [] if self.logged_in else [self.elements[(by, value)]]
+        if (by, value) == dux_browser.SELECTORS["branch_button"][0]:
+            return [self.branch_button]
+        if (by, value) == (By.CSS_SELECTOR, "tbody.ui-datatable-data"):
+            return [self.table_body]
+        if (by, value) == dux_browser.SELECTORS["next_page_button"][0]:
+            last_page = self.page >= self.page_count - 1
+            classes = "ui-paginator-next ui-state-default" + (" ui-state-disabled" if last_page else "")
+            return [FakeElement(classes=classes, on_click=self.next_page)]
+        element = self.elements.get((by, value))
+        return [element] if element else []
+
+    def find_element(self, by, value):
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise NoSuchElementException(f"No fake element for {by} {value}")
+        return elements[0]
+
+    def submit_login(self, keys):
+        if Keys.RETURN in keys:
+            self.logged_in = True
+
+    def select_branch(self):
+        self.branch_button.stale = True
+
+    def refresh_table(self):
+        if self.page_latency:
+            time.sleep(self.page_latency)
+        # Like PrimeFaces, keep the tbody and replace its rows
+        for row in self.table_body.rows:
+            row.stale = True
+        self.table_body.rows = [FakeElement(classes="ui-widget-content")]
+
+    def submit_date_filter(self, keys):
+        if Keys.RETURN in keys:
+            self.page = 0
+            self.refresh_table()
+
+    def next_page(self):
+        self.page += 1
+        self.refresh_table()
+
+
+def load_integration_module():
+    spec = importlib.util.spec_from_file_location("dux_ghl_contacts_integration", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_scenario(config):
+    """
+    Run one scenario in this process (the benchmark child) and return its timing and memory
+    """
+    integration = load_integration_module()
+    size = config["size"]
+    scenario = config["scenario"]
+    rows = [make_client_row(number) for number in range(size)]
+
+    start = time.perf_counter()
+    if scenario == "main":
+        integration.create_chrome_driver = lambda: FakeDriver(rows, config["page_rows"], config["page_latency"])
+        if integration.main() == "failed":
+            raise RuntimeError("main() run failed, see the run log")
+    elif scenario == "upsert_contacts":
+        integration.upsert_contacts(rows)
+    elif scenario == "search_invoices":
+        today = datetime.strftime(datetime.now(), "%Y-%m-%d")
+        integration.preload_contact_index()
+        integration.search_invoices(integration.RunCheckpoint.start(today, today))
+    elif scenario == "payload_mapping":
+        # Payload transforms alone, no HTTP
+        invoices = [make_invoice(1, number, max(1, size)) for number in range(size)]
+        start = time.perf_counter()
+        for row in rows:
+            integration.build_contact_payload(row, "benchmark-location")
+        contact_seconds = time.perf_counter() - start
+        for invoice in invoices:
+            integration.build_invoice_payload(invoice, "SUCURSAL 1")
+        invoice_seconds = time.perf_counter() - start - contact_seconds
+    elif scenario == "sheets_writer":
+        # Sheet writers against the in-memory worksheet, no HTTP
+        sheet_requests = run_sheet_writers(rows, config["page_rows"])
+    wall_seconds = time.perf_counter() - start
+
+    result = {"wall_seconds": round(wall_seconds, 3), "peak_memory_mb": peak_memory_mb()}
+    if scenario == "payload_mapping":
+        result["contacts_per_second"] = round(size / contact_seconds) if contact_seconds else None
+        result["invoices_per_second"] = round(size / invoice_seconds) if invoice_seconds else None
+    if scenario == "sheets_writer":
+        result["sheet_requests"] = sheet_requests
+    return result
+
+
+def run_sheet_writers(rows, page_rows):
+    """
+    Write the client rows page by page with SheetWriter, then upsert them again with SheetUpsertWriter
+    over a sheet holding every other client, checking the resulting sheets. Returns the write requests
+    made by each writer.
+    """
+    header = ["header"] * len(rows[0]) if rows else ["header"]
+    pages = [rows[start:start + page_rows] for start in range(0, len(rows), page_rows)]
+
+    worksheet = FakeWorksheet([header])
+    writer = SheetWriter(worksheet)
+    for page in pages:
+        writer.append(page)
+    writer.flush()
+    if worksheet.rows != [header] + rows:
+        raise RuntimeError("SheetWriter left the sheet with rows other than the ones appended")
+
+    existing = rows[::2]
+    worksheet = FakeWorksheet([header] + existing)
+    upsert_writer = SheetUpsertWriter(worksheet)
+    updated_rows = [row[:1] + ["updated"] + row[2:] for row in rows]
+    for start in range(0, len(updated_rows), page_rows):
+        upsert_writer.append(updated_rows[start:start + page_rows])
+    upsert_writer.flush()
+    # Existing clients keep their row, new ones are appended after them in arrival order
+    expected = [header] + updated_rows[::2] + [row for number, row in enumerate(updated_rows) if number % 2]
+    if worksheet.rows != expected:
+        raise RuntimeError("SheetUpsertWriter left the sheet with missing, duplicated or misplaced rows")
+    if (upsert_writer.rows_updated, upsert_writer.rows_appended) != (len(existing), len(rows) - len(existing)):
+        raise RuntimeError("SheetUpsertWriter counted the updated and appended rows wrong")
+    return {"overwrite": writer.requests, "upsert": upsert_writer.requests}
+
+
+def run_child(scenario, size, args, base_urls, verbose=False):
+    """
+    Run a scenario in a subprocess with its own working directory and state files
+    """
+    with tempfile.TemporaryDirectory(prefix="dux-benchmark-") as work_dir:
+        env = dict(os.environ)
+        env.update({
+            "DUX_API_BASE_URL": base_urls["dux"],
+            "GHL_API_BASE_URL": base_urls["ghl"],
+            "DUX_CLIENTS_BACKEND": args.clients_backend,
+            "DUX_STATE_DB": os.path.join(work_dir, "state.sqlite3"),
+            "DUX_CHECKPOINT_FILE": os.path.join(work_dir, "checkpoint.json"),
+            "DUX_REUSE_SESSION": "0",
+            "DUX_USERNAME": "benchmark",
+            "DUX_PASSWORD": "benchmark",
+            "DUX_ID_EMPRESA": "1",
+            "GHL_LOCATION_ID": "benchmark-location",
+            "METRICS_REPORT_DIR": os.path.join(work_dir, "metrics"),
+            "LOG_LEVEL": args.log_level,
+            "DUX_WAIT_TIMEOUT": "5",
+            "BENCHMARK_CONFIG": json.dumps({
+                "scenario": scenario, "size": size, "page_rows": args.page_rows, "page_latency": args.page_latency}),
+        })
+        env.pop("METRICS_PROMETHEUS_FILE", None)
+        if args.no_rate_limit:
+            env.update({"DUX_RATE_LIMIT": "0", "GHL_RATE_LIMIT": "0"})
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(SCRIPT_PATH), env.get("PYTHONPATH")]))
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"], cwd=work_dir, env=env,
+            stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Scenario {scenario} with {size} clients exited with code {completed.returncode}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the DUX to GHL sync against local stubs")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated scenarios to run (default: {','.join(SCENARIOS)})")
+    parser.add_argument("--sizes", default="100,1000", help="comma separated client counts (default: 100,1000)")
+    parser.add_argument("--invoices-per-client", type=float, default=2.0,
+                        help="invoices served by /facturas per client (default: 2)")
+    parser.add_argument("--branches", type=int, default=3, help="branch offices served by /sucursales (default: 3)")
+    parser.add_argument("--page-rows", type=int, default=50, help="client rows per grid page (default: 50)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stub response")
+    parser.add_argument("--page-latency", type=float, default=0.0, help="seconds added to every grid page load")
+    parser.add_argument("--rate-429", type=float, default=0.0,
+                        help="share of stub requests answered with 429 Too Many Requests (default: 0)")
+    parser.add_argument("--clients-backend", choices=("selenium", "api"), default="selenium",
+                        help="where main reads clients from: the fake WebDriver or the /clientes stub")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="disable the DUX and GHL rate limits, which otherwise apply to the stubs as in production")
+    parser.add_argument("--log-level", default="INFO", help="LOG_LEVEL of the benchmarked runs (default: INFO)")
+    parser.add_argument("--output", metavar="PATH", help="also write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the benchmarked runs")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(os.environ["BENCHMARK_CONFIG"]))))
+        return
+
+    data = StubData(latency=args.latency, rate_429=args.rate_429, branches=args.branches)
+    StubHandler.data = data
+    # One stub per API so each gets its own rate limit bucket, keyed by host:port
+    servers = {}
+    for api in ("dux", "ghl"):
+        servers[api] = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        servers[api].daemon_threads = True
+        threading.Thread(target=servers[api].serve_forever, daemon=True).start()
+    base_urls = {api: f"http://127.0.0.1:{server.server_port}" for api, server in servers.items()}
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for scenario in args.scenarios.split(","):
+            data.load(size, int(size * args.invoices_per_client))
+            result = run_child(scenario, size, args, base_urls, args.verbose)
+            result.update({
+                "scenario": scenario,
+                "clients": size,
+                "requests": sum(data.requests.values()),
+                "throttled": data.throttled,
+                "requests_by_endpoint": dict(sorted(data.requests.items())),
+            })
+            results.append(result)
+            print(f"{scenario:<16} clients={size:<7} wall={result['wall_seconds']:>8.3f}s "
+                  f"requests={result['requests']:<7} 429s={result['throttled']:<5} "
+                  f"peak_memory={result['peak_memory_mb'] or 0:.1f}MB")
+            if scenario == "payload_mapping":
+                print(f"    contacts/s={result['contacts_per_second']} invoices/s={result['invoices_per_second']}")
+            if scenario == "sheets_writer":
+                print(f"    sheet write requests: {result['sheet_requests']}")
+            for endpoint, count in result["requests_by_endpoint"].items():
+                print(f"    {endpoint:<32} {count}")
+
+    for server in servers.values():
+        server.shutdown()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
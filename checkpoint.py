@@ -0,0 +1,134 @@
+"""
+Run checkpoint used by --resume to continue an interrupted run from the last completed page,
+contact and (branch office, offset) instead of starting over from login
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('DUXScript')
+
+DEFAULT_CHECKPOINT_FILE = "state/checkpoint.json"
+
+
+def get_checkpoint_path(date_from=None, date_to=None):
+    """
+    Return the checkpoint file path, overridable with DUX_CHECKPOINT_FILE.
+    Backfill windows get their own file next to it, suffixed with the window dates.
+    """
+    path = os.getenv("DUX_CHECKPOINT_FILE", DEFAULT_CHECKPOINT_FILE)
+    if date_from is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{date_from}_{date_to}{extension}"
+
+
+class RunCheckpoint:
+    """
+    Progress of a run over a date range, saved to a JSON file after every completed unit of work:
+    - clients: pages fully upserted, contacts upserted in the current page, whether the phase is done
+    - invoices: next offset per branch office ("done" once finished)
+    The invoices kept per client and the contacts already written are appended to an event log next
+    to the JSON file, so each save only writes what changed.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.lock = threading.Lock()
+        root, _ = os.path.splitext(path)
+        self.events_path = f"{root}-invoices.jsonl"
+
+    @classmethod
+    def start(cls, date_from, date_to, resume=False, path=None):
+        """
+        Load the checkpoint when resuming, otherwise start a new one for date_from to date_to (YYYY-MM-DD)
+        """
+        path = path or get_checkpoint_path()
+        if resume:
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as file:
+                    checkpoint = cls(path, json.load(file))
+                clients = checkpoint.data["clients"]
+                logger.info(
+                    f"Resuming run of {checkpoint.date_from} to {checkpoint.date_to} from checkpoint. "
+                    f"Client pages done: {clients['pages']}, "
+                    f"Branch offices done: {sum(1 for offset in checkpoint.data['invoices']['branches'].values() if offset == 'done')}")
+                return checkpoint
+            logger.warning(f"No checkpoint found at {path}, starting a new run")
+
+        checkpoint = cls(path, {
+            "date_from": date_from,
+            "date_to": date_to,
+            "clients": {"done": False, "pages": 0, "contacts": 0},
+            "invoices": {"branches": {}},
+        })
+        # Saved right away so a later --resume never pairs an earlier run's offsets with no events,
+        # then the events left by that run are removed
+        checkpoint.save()
+        checkpoint.remove_events()
+        return checkpoint
+
+    @property
+    def date_from(self):
+        return self.data["date_from"]
+
+    @property
+    def date_to(self):
+        return self.data["date_to"]
+
+    def save(self):
+        """
+        Write the checkpoint atomically so a crash never leaves a truncated file
+        """
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as file:
+                json.dump(self.data, file)
+            os.replace(temporary_path, self.path)
+
+    def append_events(self, events):
+        """
+        Append invoice progress events (dicts) to the event log
+        """
+        if not events:
+            return
+        with self.lock:
+            directory = os.path.dirname(self.events_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.events_path, "a", encoding="utf-8") as file:
+                file.write("".join(json.dumps(event) + "\n" for event in events))
+
+    def read_events(self):
+        """
+        Return the events logged so far, ignoring a last line cut short by a crash
+        """
+        if not os.path.exists(self.events_path):
+            return []
+        events = []
+        with open(self.events_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Ignoring truncated event in {self.events_path}")
+        return events
+
+    def remove_events(self):
+        with self.lock:
+            if os.path.exists(self.events_path):
+                os.remove(self.events_path)
+
+    def clear(self):
+        """
+        Remove the checkpoint and its event log once the run has completed
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self.remove_events()
@@ -1,37 +1,63 @@
 #!/usr/bin/env python3
-from selenium import webdriver
-from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import argparse
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import time
 from datetime import timedelta, datetime
+from functools import lru_cache
 import os
 from dotenv import load_dotenv
-import requests
 import json
 import traceback
 import logging
 from logging.handlers import RotatingFileHandler
-import csv
 import re
 import sys
 import platform
 import socket
+import queue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http_client import get_http_client
+from state_store import (
+    BackfillWindowStore,
+    get_contact_cache,
+    get_contact_index,
+    get_latest_invoice_store,
+    get_payload_hash_store,
+    hash_payload,
+)
+from checkpoint import RunCheckpoint, get_checkpoint_path
+from metrics import get_metrics
+from payload_mapping import SKIP, Context, compile_payload_mapping
+from pipeline import chunked, spill_pages_to_csv
+from dux_api import fetch_clients, get_branch_catalog, get_dux_api_base_url
+from dux_browser import (
+    CLIENTS_PAGE_URL,
+    SelectorRegistry,
+    StepTimer,
+    create_chrome_driver,
+    extract_table_rows,
+    find_first_table_row,
+    get_wait_timeout,
+    log_page_size_savings,
+    maximize_page_size,
+    open_dux_page,
+    wait_for_ajax_idle,
+    wait_for_table_refresh,
+)
+
+
+EMAIL_REGEX = re.compile(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
 
 
 def is_valid_email(email):
     """
     Checks if the email format is valid using regex.
     """
-    email_regex = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
-    return re.match(email_regex, email) is not None
+    return EMAIL_REGEX.match(email) is not None
 
 
 def send_error_email(error_message):
@@ -97,7 +123,9 @@ def setup_logging():
 
     # Create logger
     logger = logging.getLogger('DUXScript')
-    logger.setLevel(logging.DEBUG)
+    # Level of logs/dux_script.log, e.g. LOG_LEVEL=INFO to skip the API request/response details
+    file_log_level = getattr(logging, os.getenv("LOG_LEVEL", "DEBUG").upper(), logging.DEBUG)
+    logger.setLevel(min(file_log_level, logging.INFO))
 
     # Create formatters
     file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -111,7 +139,7 @@ def setup_logging():
         backupCount=7,
         encoding='utf-8'
     )
-    file_handler.setLevel(logging.DEBUG)
+    file_handler.setLevel(file_log_level)
     file_handler.setFormatter(file_formatter)
     file_handler.suffix = "%Y-%m-%d.log"  # Add date to the log file name
 
@@ -127,8 +155,33 @@ def setup_logging():
     return logger
 
 
-logger = setup_logging()
 load_dotenv()
+logger = setup_logging()
+
+# API payloads and bodies longer than this are truncated in the debug log, override with LOG_API_BODY_LIMIT
+DEFAULT_LOG_API_BODY_LIMIT = 2000
+# Share of successful API calls whose details are logged, override with LOG_API_SAMPLE_RATE
+DEFAULT_LOG_API_SAMPLE_RATE = 1.0
+DEFAULT_GHL_API_BASE_URL = "https://services.leadconnectorhq.com"
+# Concurrent GHL upsert requests, override with GHL_UPSERT_WORKERS
+DEFAULT_UPSERT_WORKERS = 5
+# Clients requested per page from the DUX REST API
+DUX_CLIENTS_PAGE_SIZE = 50
+# Invoices requested per page from /facturas
+INVOICES_PAGE_SIZE = 50
+# Contact updates between checkpoint saves in the invoice phase
+CHECKPOINT_SAVE_INTERVAL = 25
+# Client rows turned into payloads and sent per batch
+UPSERT_CHUNK_SIZE = 100
+
+# Branch offices whose invoices are fetched in parallel, override with DUX_BRANCH_WORKERS
+DEFAULT_BRANCH_WORKERS = 4
+
+# Contacts requested per page when preloading the GHL contact index
+CONTACT_PRELOAD_PAGE_SIZE = 500
+# Days between full contact index refreshes (dropping contacts deleted in GHL), override with
+# CONTACT_INDEX_FULL_REFRESH_DAYS
+DEFAULT_CONTACT_INDEX_FULL_REFRESH_DAYS = 7
 
 csv_clients_dictionary = {
     "id": 0,
@@ -161,107 +214,533 @@ csv_clients_dictionary = {
 }
 
 
-def main():
-    driver = None
+def format_first_name(cliente):
+    return cliente.replace(",", "").title()
+
+
+def valid_email_or_skip(email):
+    return email if is_valid_email(email) else SKIP
+
+
+FECHA_COMP_MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+}
+
+
+@lru_cache(maxsize=65536)
+def parse_fecha_comp(fecha_comp):
+    """
+    Parse a DUX invoice date ("Jan 05, 2024 03:04:05 PM") without strptime, which is slow and
+    depends on the locale. Cached since the sort key and the payload parse the same date.
+    """
     try:
-        logger.info("Starting DUX script execution")
-        all_clients_list = []
-
-        # Configurar Selenium con Chrome
-        logger.debug("Initializing Chrome WebDriver")
-        options = Options()
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--window-size=1920,1080')
-        options.add_argument("--disable-blink-features=AutomationControlled")
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-
-        # Paso 1: Ir a la página de login
-        logger.info("Navigating to DUX login page")
-        driver.get("https://erp.duxsoftware.com.ar/")
-
-        # Paso 2: Ingresar credenciales
-        logger.debug("Entering login credentials")
-        driver.find_element(By.ID, "formLogin:inputUsuario").send_keys(os.getenv("DUX_USERNAME"))
-        driver.find_element(By.ID, "formLogin:inputPassword").send_keys(os.getenv("DUX_PASSWORD"), Keys.RETURN)
-
-        logger.debug("Waiting for page load after login")
-        time.sleep(5)
-
-        # Paso 3: Aceptar select de sucursal
-        logger.debug("Selecting branch office")
-        driver.find_element(By.ID, "formInicio:j_idt910").click()
-        time.sleep(5)
-
-        # Paso 4: Navegar a pagina de clientes
-        logger.info("Navigating to clients page")
-        driver.get("https://erp.duxsoftware.com.ar/pages/configuracion/cliente/listaClienteBeta.faces")
-        time.sleep(7)
-
-        # Paso 5 y 6: Configurar fecha
-        # driver.find_element(By.CLASS_NAME, "announcekit-booster-modal-close").click()
-        logger.debug("Configuring date filters")
-        driver.find_element(By.ID, "formCabecera:j_idt1031_label").click()
-        driver.find_element(By.ID, "formCabecera:j_idt1031_3").click()
-
-        time.sleep(10)
-
-        # Paso 7: Escribir fecha y dar enter
-        today = datetime.now()
-        today_string_dux = datetime.strftime(today, "%d%m%y")
-        logger.debug(f"Setting date filter to: {today_string_dux}")
-        wait = WebDriverWait(driver, 10)
-        input_element = wait.until(EC.presence_of_element_located((By.ID, "formCabecera:j_idt1041_input")))
-        input_element.click()
-        input_element.send_keys(today_string_dux)
-        input_element = wait.until(EC.presence_of_element_located((By.ID, "formCabecera:j_idt1047_input")))
-        input_element.click()
-        input_element.send_keys(today_string_dux, Keys.RETURN)
+        month, day, year, clock, meridiem = fecha_comp.replace(",", " ").split()
+        hour, minute, second = clock.split(":")
+        hour = int(hour)
+        if not 1 <= hour <= 12 or meridiem.upper() not in ("AM", "PM"):
+            raise ValueError(f"hour {clock} {meridiem} out of range")
+        hour = hour % 12 + (12 if meridiem.upper() == "PM" else 0)
+        return datetime(int(year), FECHA_COMP_MONTHS[month.title()], int(day), hour, int(minute), int(second))
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid fecha_comp: {fecha_comp!r}") from None
 
-        time.sleep(5)
 
-        # Paso 8: Extraer datos de la tabla
-        button_next_page_disabled = False
-        page_number = 1
+# Zero-padded months and days, looked up instead of formatted with :02d for every invoice
+# (DUX years always have four digits)
+TWO_DIGITS = [f"{number:02d}" for number in range(32)]
 
-        logger.info("Starting data extraction from table")
-        while not button_next_page_disabled:
-            logger.debug(f"Processing page {page_number}")
-            iterate_table(driver, all_clients_list)
-            button_next_page = driver.find_element(By.XPATH,
-                                                   "/html/body/div[2]/div[4]/div/div[2]/div/form/div/div[5]/a[3]")
-            button_next_page_class = button_next_page.get_attribute("class")
-            button_next_page_classes = button_next_page_class.split(" ")
-            button_next_page_disabled = "ui-state-disabled" in button_next_page_classes
-
-            if not button_next_page_disabled:
-                logger.debug(f"Moving to page {page_number + 1}")
-                button_next_page.click()
-                time.sleep(10)
-                page_number += 1
-            else:
-                logger.info("Reached last page of results")
-                button_next_page_disabled = True
 
-        search_invoices()
+def format_invoice_date(fecha_comp):
+    fecha = parse_fecha_comp(fecha_comp)
+    return f"{fecha.year}/{TWO_DIGITS[fecha.month]}/{TWO_DIGITS[fecha.day]}"
+
+
+def contrata_comodato(detalles):
+    """
+    SI if any product of the invoice is a COMODATO, stopping at the first one
+    """
+    for producto in detalles:
+        if "COMODATO" in producto["item"]:
+            return "SI"
+    return "NO"
+
+
+def first_budget_value(key):
+    return lambda presupuesto: presupuesto[0][key] if presupuesto else ""
+
+
+# GHL upsert payload of a client row (csv_clients_dictionary layout), context: location_id.
+# An invalid email is left out (SKIP), every other value is sent as is, None included
+CONTACT_PAYLOAD_SPEC = {
+    "fields": [
+        ("locationId", Context("location_id")),
+        ("firstName", "cliente", format_first_name),
+        ("phone", ("celular", "telefono"), lambda phones: phones[0] or phones[1]),
+        ("email", "correo_electronico", valid_email_or_skip),
+    ],
+    "custom_fields": [
+        ("id_cliente_dux", "id"),
+        ("categoria_fiscal_dux", "categoria_fiscal"),
+        ("tipo_documento_dux", "tipo_documento"),
+        ("numero_documento_dux", "numero_documento"),
+        ("cuit_cuil_dux", "cuit/cuil"),
+        ("tipo_cliente_dux", "tipo_cliente"),
+        ("provincia_dux", "provincia"),
+        ("barrio_dux", "barrio"),
+        ("direccion_facturacion_dux", "domicilio"),
+        ("codigo_postal_dux", "codigo"),
+        ("email_facturacion_dux", "correo_electronico", valid_email_or_skip),
+    ],
+}
+
+# GHL contact update payload of a DUX invoice, context: nombre_sucursal
+INVOICE_PAYLOAD_SPEC = {
+    "custom_fields": [
+        ("id_factura_dux", "id"),
+        ("numero_punto_venta_dux", "nro_pto_vta"),
+        ("id_personal_dux", "id_personal"),
+        ("id_vendedor_dux", "id_vendedor"),
+        ("tipo_comprobante_dux", "tipo_comp"),
+        ("numero_comprobante_dux", "nro_comp"),
+        ("fecha_comprobante_dux", "fecha_comp", format_invoice_date),
+        ("monto_sin_iva_dux", "monto_gravado"),
+        ("monto_total_dux", "total"),
+        ("nombre_sucursal_dux", Context("nombre_sucursal")),
+        ("tiene_cobro", "detalles_cobro", lambda detalles_cobro: "SI" if detalles_cobro else "NO"),
+        ("presupuesto_numero_dux", "presupuesto", first_budget_value("nro_presupuesto")),
+        ("presupuesto_estado_dux", "presupuesto", first_budget_value("estado")),
+        ("contrata_comodato_dux", "detalles", contrata_comodato),
+    ],
+}
+
+transform_contact = compile_payload_mapping(CONTACT_PAYLOAD_SPEC, csv_clients_dictionary)
+transform_invoice = compile_payload_mapping(INVOICE_PAYLOAD_SPEC)
 
+
+def get_ghl_api_base_url():
+    """
+    Return the GHL API base URL, overridable with GHL_API_BASE_URL (e.g. to point at a local stub server)
+    """
+    return os.getenv("GHL_API_BASE_URL", DEFAULT_GHL_API_BASE_URL).rstrip("/")
+
+
+def main(force=False, spill_csv=None, resume=False, date_from=None, date_to=None, window="day", workers=1):
+    """
+    Sync today's clients and invoices, or backfill date_from to date_to. Returns the run status ("success" or "failed").
+    """
+    step_timer = StepTimer()
+    run_status = "failed"
+    try:
+        logger.info("Starting DUX script execution")
+        if force:
+            logger.info("Forcing GHL writes, unchanged payloads will be sent again")
+            get_payload_hash_store().force = True
+
+        # Once per run, before any window reads the index (backfill windows run in parallel)
+        if os.getenv("GHL_CONTACT_PRELOAD", "true").lower() != "false":
+            with step_timer.step("Contact preload"):
+                preload_contact_index()
+
+        if date_from:
+            run_backfill(date_from, date_to or date_from, window, workers, step_timer,
+                         force=force, spill_csv=spill_csv, resume=resume)
+        else:
+            today = datetime.strftime(datetime.now(), "%Y-%m-%d")
+            run_window(today, today, step_timer, spill_csv=spill_csv, resume=resume)
+
+        run_status = "success"
         logger.info("Script execution completed successfully")
 
-    except NoRowsFoundException:
-        logger.info("Script finished: No rows found to process")
     except Exception as e:
         error_details = traceback.format_exc()
         logger.error(f"An error occurred: {str(e)}")
         logger.error(f"Stack trace: {error_details}")
         send_error_email(error_details)
+    finally:
+        step_timer.log_report()
+        get_metrics().write_reports("dux-ghl-contacts", run_status)
+    return run_status
+
+
+def run_window(date_from, date_to, step_timer, spill_csv=None, resume=False, checkpoint_path=None):
+    """
+    Sync the clients created and the invoices issued from date_from to date_to (YYYY-MM-DD) into GHL
+    """
+    upsert_summary = {"pages": 0, "contacts_sent": 0, "contacts_skipped": 0, "legacy_calls": 0}
+    checkpoint = RunCheckpoint.start(date_from, date_to, resume=resume, path=checkpoint_path)
+    try:
+        run_clients_phase(checkpoint, upsert_summary, step_timer, spill_csv)
+    except NoRowsFoundException:
+        # Invoices are still synced, clients created on other days can be invoiced in this window
+        logger.info(f"No new clients from {checkpoint.date_from} to {checkpoint.date_to}")
+        checkpoint.data["clients"]["done"] = True
+        checkpoint.save()
+    log_upsert_summary(upsert_summary)
+
+    with step_timer.step("Invoice search"):
+        search_invoices(checkpoint)
+    checkpoint.clear()
+
+
+def split_date_range(date_from, date_to, window="day"):
+    """
+    Split the inclusive range date_from to date_to (YYYY-MM-DD) into consecutive day or week windows
+    """
+    start = datetime.strptime(date_from, "%Y-%m-%d")
+    end = datetime.strptime(date_to, "%Y-%m-%d")
+    if start > end:
+        raise ValueError(f"Backfill start date {date_from} is after end date {date_to}")
+    step = timedelta(days=7 if window == "week" else 1)
+
+    windows = []
+    while start <= end:
+        window_end = min(start + step - timedelta(days=1), end)
+        windows.append((datetime.strftime(start, "%Y-%m-%d"), datetime.strftime(window_end, "%Y-%m-%d")))
+        start = window_end + timedelta(days=1)
+    return windows
+
+
+def run_backfill(date_from, date_to, window, workers, step_timer, force=False, spill_csv=None, resume=False):
+    """
+    Reprocess a date range as day or week windows, running up to `workers` windows at a time.
+    Every HTTP call still goes through the shared rate-limited client. Completed windows are
+    recorded in the state database and skipped on later backfills unless forcing.
+    """
+    window_store = BackfillWindowStore()
+    windows = split_date_range(date_from, date_to, window)
+    pending_windows = [w for w in windows if force or not window_store.is_done(*w)]
+    logger.info(
+        f"Backfill from {date_from} to {date_to}. Windows: {len(windows)} ({window}), "
+        f"Already done: {len(windows) - len(pending_windows)}, Workers: {workers}")
+
+    def process_window(date_window):
+        window_from, window_to = date_window
+        window_spill_csv = None
+        if spill_csv:
+            root, extension = os.path.splitext(spill_csv)
+            window_spill_csv = f"{root}-{window_from}_{window_to}{extension}"
+        try:
+            logger.info(f"Processing backfill window {window_from} to {window_to}")
+            with step_timer.step("Backfill window"):
+                run_window(window_from, window_to, step_timer, spill_csv=window_spill_csv, resume=resume,
+                           checkpoint_path=get_checkpoint_path(window_from, window_to))
+            window_store.mark_done(window_from, window_to)
+            return True
+        except Exception as e:
+            logger.error(f"Backfill window {window_from} to {window_to} failed: {str(e)}")
+            logger.error(f"Stack trace: {traceback.format_exc()}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(process_window, pending_windows))
+
+    failed_windows = [w for w, succeeded in zip(pending_windows, results) if not succeeded]
+    logger.info(f"Backfill completed. Windows processed: {len(pending_windows) - len(failed_windows)}, "
+                f"Failed: {len(failed_windows)}")
+    if failed_windows:
+        raise Exception(
+            "Backfill windows failed: " + ", ".join(f"{window_from} to {window_to}" for window_from, window_to in failed_windows))
+
+
+def run_clients_phase(checkpoint, upsert_summary, step_timer, spill_csv=None):
+    """
+    Upsert the clients of the checkpoint's date range from the configured backend, continuing after the pages already in the checkpoint
+    """
+    if checkpoint.data["clients"]["done"]:
+        logger.info("Client upsert already completed for this run, skipping to invoices")
+        return
+
+    driver = None
+    skip_pages = checkpoint.data["clients"]["pages"]
+    try:
+        clients_backend = os.getenv("DUX_CLIENTS_BACKEND", "selenium").lower()
+        if clients_backend == "api":
+            logger.info("Fetching clients from the DUX REST API")
+            client_pages = fetch_clients(checkpoint.date_from, checkpoint.date_to,
+                                         start_offset=skip_pages * DUX_CLIENTS_PAGE_SIZE,
+                                         limit=DUX_CLIENTS_PAGE_SIZE)
+        else:
+            # Configurar Selenium con Chrome
+            logger.debug("Initializing Chrome WebDriver")
+            with step_timer.step("Browser startup"):
+                driver = create_chrome_driver()
+
+            client_pages = scrape_clients(driver, step_timer, checkpoint.date_from, checkpoint.date_to,
+                                          skip_pages=skip_pages)
+
+        # Pages stream from the source straight into the GHL sink, only spilled to disk on request
+        if spill_csv:
+            logger.info(f"Spilling client rows to {spill_csv}")
+            client_pages = spill_pages_to_csv(client_pages, spill_csv)
+        upsert_client_pages(client_pages, upsert_summary, step_timer, checkpoint)
+
+        checkpoint.data["clients"]["done"] = True
+        checkpoint.save()
     finally:
         if driver:
             logger.debug("Closing Chrome WebDriver")
             driver.quit()
 
 
-def upsert_contacts():
+def scrape_clients(driver, step_timer, date_from, date_to, skip_pages=0):
+    """
+    Log into DUX, filter the clients grid from date_from to date_to (YYYY-MM-DD) and yield the client rows of every page
+    after the first skip_pages, which are only paged through
+    """
+    # Paso 1 a 4: Iniciar sesión (o reutilizar la guardada) y navegar a pagina de clientes
+    logger.info("Navigating to clients page")
+    selectors = SelectorRegistry(driver)
+    open_dux_page(driver, step_timer, CLIENTS_PAGE_URL, selectors)
+    with step_timer.step("Clients page"):
+        date_filter_menu = selectors.find("date_filter_menu", get_wait_timeout("clients_page"), clickable=True)
+        wait_for_ajax_idle(driver, get_wait_timeout("clients_page"))
+
+    # Paso 5 y 6: Configurar fecha
+    # driver.find_element(By.CLASS_NAME, "announcekit-booster-modal-close").click()
+    logger.debug("Configuring date filters")
+    with step_timer.step("Date filter selection"):
+        date_filter_menu.click()
+        selectors.find("date_filter_range_option", get_wait_timeout("date_filter"), clickable=True).click()
+        wait_for_ajax_idle(driver, get_wait_timeout("date_filter"))
+
+    # Paso 7: Escribir fecha y dar enter
+    date_from_dux = datetime.strftime(datetime.strptime(date_from, "%Y-%m-%d"), "%d%m%y")
+    date_to_dux = datetime.strftime(datetime.strptime(date_to, "%Y-%m-%d"), "%d%m%y")
+    logger.debug(f"Setting date filter from {date_from_dux} to {date_to_dux}")
+    with step_timer.step("Date filter search"):
+        input_element = selectors.find("date_from_input", get_wait_timeout("date_filter"), clickable=True)
+        input_element.click()
+        input_element.send_keys(date_from_dux)
+        input_element = selectors.find("date_to_input", get_wait_timeout("date_filter"), clickable=True)
+        input_element.click()
+        first_row = find_first_table_row(driver)
+        input_element.send_keys(date_to_dux, Keys.RETURN)
+        wait_for_table_refresh(driver, first_row, get_wait_timeout("table"))
+
+    # Mostrar la mayor cantidad de filas por página para reducir la paginación
+    with step_timer.step("Page size"):
+        page_size = maximize_page_size(driver, selectors, get_wait_timeout("table"))
+
+    # Paso 8: Extraer datos de la tabla
+    button_next_page_disabled = False
+    page_number = 1
+    rows_scraped = 0
+
+    logger.info("Starting data extraction from table")
+    while not button_next_page_disabled:
+        if page_number <= skip_pages:
+            logger.debug(f"Skipping page {page_number}, already processed")
+        else:
+            logger.debug(f"Processing page {page_number}")
+            with step_timer.step("Page scrape"):
+                page_clients_list = iterate_table(driver)
+            rows_scraped += len(page_clients_list)
+            yield page_clients_list
+
+        button_next_page = selectors.find("next_page_button", get_wait_timeout("table"))
+        button_next_page_class = button_next_page.get_attribute("class")
+        button_next_page_classes = button_next_page_class.split(" ")
+        button_next_page_disabled = "ui-state-disabled" in button_next_page_classes
+
+        if not button_next_page_disabled:
+            logger.debug(f"Moving to page {page_number + 1}")
+            with step_timer.step("Next page load"):
+                first_row = find_first_table_row(driver)
+                button_next_page.click()
+                wait_for_table_refresh(driver, first_row, get_wait_timeout("table"))
+            page_number += 1
+        else:
+            logger.info("Reached last page of results")
+            button_next_page_disabled = True
+
+    log_page_size_savings(step_timer, page_size, rows_scraped, page_number - skip_pages)
+
+
+def upsert_client_pages(client_pages, upsert_summary, step_timer, checkpoint):
+    """
+    Upsert every page of client rows yielded by the scraper or the DUX API, recording each
+    completed page and, within a page, each completed chunk of contacts in the checkpoint
+    """
+    progress = checkpoint.data["clients"]
+    for page_clients_list in client_pages:
+        contacts_done = progress["contacts"]
+        if contacts_done:
+            logger.info(f"Resuming page {progress['pages'] + 1} after contact {contacts_done}")
+
+        def save_progress(contacts_processed):
+            progress["contacts"] = contacts_done + contacts_processed
+            checkpoint.save()
+
+        with step_timer.step("Page upsert"):
+            upsert_clients_page(page_clients_list[contacts_done:], upsert_summary, save_progress)
+        progress["pages"] += 1
+        progress["contacts"] = 0
+        checkpoint.save()
+
+    if progress["pages"] == 0:
+        logger.warning("No client rows to process, stopping execution")
+        raise NoRowsFoundException("No rows were found to process")
+
+
+def build_contact_payload(row, location_id):
+    """
+    Build the GHL upsert payload for a client row in csv_clients_dictionary layout
+    """
+    return transform_contact(row, {"location_id": location_id})
+
+
+def send_contact_upsert(url, headers, payload):
+    """
+    Post one contact to the GHL upsert endpoint. Returns (response, error) so the caller can log results in order.
+    """
+    try:
+        return get_http_client().request("POST", url, headers=headers, data=json.dumps(payload)), None
+    except Exception as e:
+        return None, e
+
+
+def cache_upserted_contact_id(id_cliente_dux, response):
+    """
+    Remember the GHL contact id returned by /contacts/upsert so invoices can skip the contact search
+    """
+    try:
+        contact_id = response.json().get("contact", {}).get("id")
+        if id_cliente_dux and contact_id:
+            get_contact_cache().set(id_cliente_dux, contact_id)
+    except Exception as e:
+        logger.warning(f"Could not cache contact id for DUX client {id_cliente_dux}: {str(e)}")
+
+
+def get_id_cliente_dux_field_id(headers):
+    """
+    Return the id of the id_cliente_dux custom field (search results carry custom fields by id),
+    from GHL_ID_CLIENTE_DUX_FIELD_ID or the location's custom fields
+    """
+    field_id = os.getenv("GHL_ID_CLIENTE_DUX_FIELD_ID")
+    if field_id:
+        return field_id
+
+    url = f"{get_ghl_api_base_url()}/locations/{os.getenv('GHL_LOCATION_ID')}/customFields"
+    response = get_http_client().request("GET", url, headers=headers)
+    log_api_request("GET", url, headers, response=response)
+    if not response.ok:
+        raise Exception(
+            f"Failed to fetch custom fields. Status code: {response.status_code}, Response: {response.text}")
+
+    for field in response.json().get("customFields", []):
+        if field.get("fieldKey") in ("contact.id_cliente_dux", "id_cliente_dux"):
+            return field["id"]
+    raise Exception("Custom field id_cliente_dux not found in the GHL location")
+
+
+def preload_contact_index():
+    """
+    Page through every GHL contact with an id_cliente_dux into the local contact index, so the invoice
+    phase resolves contacts without one search per client. Only contacts updated since the last
+    preload are fetched, with a full refresh every CONTACT_INDEX_FULL_REFRESH_DAYS.
+    Returns False if the preload failed and contacts have to be searched one by one.
+    """
+    location_id = os.getenv("GHL_LOCATION_ID")
+    contact_index = get_contact_index()
+    watermark, full_refresh_at = contact_index.load(location_id)
+    full_refresh_days = float(os.getenv("CONTACT_INDEX_FULL_REFRESH_DAYS", DEFAULT_CONTACT_INDEX_FULL_REFRESH_DAYS))
+    full_refresh = full_refresh_at is None or time.time() - full_refresh_at > full_refresh_days * 24 * 3600
+
+    url = f"{get_ghl_api_base_url()}/contacts/search"
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Version': '2021-07-28',
+        'Authorization': f'Bearer {os.getenv("GHL_PRIVATE_INTEGRATION_KEY")}'
+    }
+    filters = [{"field": "customFields.id_cliente_dux", "operator": "exists"}]
+    if not full_refresh and watermark:
+        # gte so contacts updated in the same instant as the watermark are not missed
+        filters.append({"field": "dateUpdated", "operator": "range", "value": {"gte": watermark}})
+    logger.info(f"Preloading GHL contacts ({'full' if full_refresh else f'updated since {watermark}'})")
+
+    try:
+        field_id = get_id_cliente_dux_field_id(headers)
+        contacts = []
+        page = 1
+        search_after = None
+        while True:
+            payload = {
+                "locationId": location_id,
+                "pageLimit": CONTACT_PRELOAD_PAGE_SIZE,
+                "filters": filters,
+                "sort": [{"field": "dateUpdated", "direction": "asc"}]
+            }
+            # searchAfter pages past the 10000 results reachable with page numbers
+            if search_after:
+                payload["searchAfter"] = search_after
+            else:
+                payload["page"] = page
+            response = get_http_client().request("POST", url, headers=headers, data=json.dumps(payload))
+            log_api_request("POST", url, headers, payload, response=response)
+            if not response.ok:
+                raise Exception(
+                    f"Failed to preload contacts. Status code: {response.status_code}, Response: {response.text}")
+
+            page_contacts = response.json().get("contacts", [])
+            for contact in page_contacts:
+                id_cliente_dux = next((field.get("value") for field in contact.get("customFields", [])
+                                       if field.get("id") == field_id), None)
+                if id_cliente_dux:
+                    date_updated = contact.get("dateUpdated") or contact.get("dateAdded")
+                    contacts.append((id_cliente_dux, contact["id"], date_updated))
+                    if date_updated and (watermark is None or date_updated > watermark):
+                        watermark = date_updated
+
+            if len(page_contacts) < CONTACT_PRELOAD_PAGE_SIZE:
+                break
+            page += 1
+            search_after = page_contacts[-1].get("searchAfter")
+
+        contact_index.update(location_id, contacts, watermark, full_refresh)
+        logger.info(f"GHL contact index: {len(contact_index.contacts)} contacts, {len(contacts)} fetched in {page} pages")
+        get_metrics().increment("contacts_preloaded", len(contacts), refresh="full" if full_refresh else "incremental")
+        return True
+    except Exception as e:
+        logger.warning(f"Could not preload GHL contacts, searching them one by one: {str(e)}")
+        return False
+
+
+def get_contact_id(id_cliente_dux):
+    """
+    Return the GHL contact id for a DUX client id from the preloaded contact index or the local cache,
+    falling back to the search API while the index is not complete
+    """
+    contact_index = get_contact_index()
+    contact_id = contact_index.get(id_cliente_dux)
+    if contact_id is not None:
+        return contact_id
+
+    contact_cache = get_contact_cache()
+    contact_id = contact_cache.get(id_cliente_dux)
+    if contact_id is not None:
+        return contact_id
+
+    if contact_index.complete:
+        logger.debug(f"No GHL contact for DUX client {id_cliente_dux}")
+        return None
+
+    search_contact_result = search_contact_by_id_cliente_dux(id_cliente_dux)
+    if len(search_contact_result['contacts']) > 0:
+        contact_id = search_contact_result['contacts'][0]['id']
+        contact_cache.set(id_cliente_dux, contact_id)
+        return contact_id
+    return None
+
+
+def upsert_contacts(client_rows, progress_callback=None):
+    """
+    Upsert an iterable of client rows (csv_clients_dictionary layout) into GHL.
+    Rows are consumed in bounded chunks so memory stays constant whatever the input size.
+    progress_callback, if given, is called with the number of rows processed after each chunk.
+    Returns (contacts sent, unchanged contacts skipped).
+    """
     try:
         logger.info("Starting contact upsert process")
         location_id = os.getenv("GHL_LOCATION_ID")
@@ -271,99 +750,60 @@ def upsert_contacts():
             'Version': '2021-07-28',
             'Authorization': f'Bearer {os.getenv("GHL_PRIVATE_INTEGRATION_KEY")}'
         }
-        url = "https://services.leadconnectorhq.com/contacts/upsert"
-
-        logger.debug("Reading clients.csv file")
-        with open("clients.csv", "r") as file:
-            csvreader = csv.reader(file)
-            total_contacts = 0
-            successful_upserts = 0
-
-            for row in csvreader:
-                total_contacts += 1
-                try:
-                    logger.debug(f"Processing contact {total_contacts}: {row[csv_clients_dictionary['cliente']]}")
-                    first_name_formatted = row[csv_clients_dictionary["cliente"]].replace(",", "").title()
-                    payload = {
-                        "locationId": location_id,
-                        "firstName": first_name_formatted,
-                        "phone": row[csv_clients_dictionary["telefono"]] if not row[
-                            csv_clients_dictionary["celular"]] else row[
-                            csv_clients_dictionary["celular"]],
-                        "customFields": [
-                            {
-                                "key": "id_cliente_dux",
-                                "field_value": row[csv_clients_dictionary["id"]]
-                            },
-                            {
-                                "key": "categoria_fiscal_dux",
-                                "field_value": row[csv_clients_dictionary["categoria_fiscal"]]
-                            },
-                            {
-                                "key": "tipo_documento_dux",
-                                "field_value": row[csv_clients_dictionary["tipo_documento"]]
-                            },
-                            {
-                                "key": "numero_documento_dux",
-                                "field_value": row[csv_clients_dictionary["numero_documento"]]
-                            },
-                            {
-                                "key": "cuit_cuil_dux",
-                                "field_value": row[csv_clients_dictionary["cuit/cuil"]]
-                            },
-                            {
-                                "key": "tipo_cliente_dux",
-                                "field_value": row[csv_clients_dictionary["tipo_cliente"]]
-                            },
-                            {
-                                "key": "provincia_dux",
-                                "field_value": row[csv_clients_dictionary["provincia"]]
-                            },
-                            {
-                                "key": "barrio_dux",
-                                "field_value": row[csv_clients_dictionary["barrio"]]
-                            },
-                            {
-                                "key": "direccion_facturacion_dux",
-                                "field_value": row[csv_clients_dictionary["domicilio"]]
-                            },
-                            {
-                                "key": "codigo_postal_dux",
-                                "field_value": row[csv_clients_dictionary["codigo"]]
-                            },
-                        ]
-                    }
-
-                    if is_valid_email(row[csv_clients_dictionary["correo_electronico"]]):
-                        payload["email"] = row[csv_clients_dictionary["correo_electronico"]]
-                        payload["customFields"].append({
-                            "key": "email_facturacion_dux",
-                            "value": row[csv_clients_dictionary["correo_electronico"]]
-                        })
-
+        url = f"{get_ghl_api_base_url()}/contacts/upsert"
+        upsert_workers = max(1, int(os.getenv("GHL_UPSERT_WORKERS", DEFAULT_UPSERT_WORKERS)))
+        total_contacts = 0
+        successful_upserts = 0
+        skipped_upserts = 0
+        payload_hashes = get_payload_hash_store()
+
+        # Requests run concurrently under the shared GHL rate limit; results are consumed in
+        # submission order so the log reads the same as a sequential run
+        with ThreadPoolExecutor(max_workers=upsert_workers) as executor:
+            for rows in chunked(client_rows, UPSERT_CHUNK_SIZE):
+                pending_upserts = []
+                for row in rows:
+                    total_contacts += 1
                     try:
-                        response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
-                        log_api_request("POST", url, headers, payload, response=response)
-
-                        if response.ok:
-                            successful_upserts += 1
-                            logger.debug(f"Successfully upserted contact {total_contacts}")
-                        else:
-                            logger.error(
-                                f"Failed to upsert contact {total_contacts}. Status code: {response.status_code}, Response: {response.text}")
+                        logger.debug(f"Processing contact {total_contacts}: {row[csv_clients_dictionary['cliente']]}")
+                        payload = build_contact_payload(row, location_id)
+                        payload_hash = hash_payload(payload)
+                        if payload_hashes.is_unchanged("contact", row[csv_clients_dictionary["id"]], payload_hash):
+                            skipped_upserts += 1
+                            logger.debug(f"Skipping unchanged contact {total_contacts}")
+                            continue
+                        pending_upserts.append(
+                            (total_contacts, row[csv_clients_dictionary["id"]], payload, payload_hash))
                     except Exception as e:
-                        log_api_request("POST", url, headers, payload, error=e)
                         logger.error(f"Error processing contact {total_contacts}: {str(e)}")
                         continue
 
-                except Exception as e:
-                    logger.error(f"Error processing contact {total_contacts}: {str(e)}")
-                    continue
+                results = executor.map(lambda pending: send_contact_upsert(url, headers, pending[2]), pending_upserts)
+                for (contact_number, id_cliente_dux, payload, payload_hash), (response, error) in zip(pending_upserts,
+                                                                                                       results):
+                    if error is not None:
+                        log_api_request("POST", url, headers, payload, error=error)
+                        logger.error(f"Error processing contact {contact_number}: {str(error)}")
+                        continue
 
-            logger.info(
-                f"Contact upsert process completed. Total contacts: {total_contacts}, Successful: {successful_upserts}")
+                    log_api_request("POST", url, headers, payload, response=response)
+                    if response.ok:
+                        successful_upserts += 1
+                        logger.debug(f"Successfully upserted contact {contact_number}")
+                        cache_upserted_contact_id(id_cliente_dux, response)
+                        payload_hashes.record("contact", id_cliente_dux, payload_hash)
+                    else:
+                        logger.error(
+                            f"Failed to upsert contact {contact_number}. Status code: {response.status_code}, Response: {response.text}")
 
-        os.remove('clients.csv')
+                if progress_callback:
+                    progress_callback(total_contacts)
+
+        logger.info(
+            f"Contact upsert process completed. Total contacts: {total_contacts}, Successful: {successful_upserts}, "
+            f"Unchanged skipped: {skipped_upserts}")
+
+        return total_contacts - skipped_upserts, skipped_upserts
 
     except Exception as e:
         error_details = traceback.format_exc()
@@ -373,10 +813,14 @@ def upsert_contacts():
         raise
 
 
-def search_invoices():
+def search_invoices(checkpoint):
+    """
+    Update the GHL contact of every client invoiced in the checkpoint's date range with its latest invoice.
+    Progress (next offset per branch office, latest invoices, contacts written) is saved to the checkpoint.
+    Raises once the contacts are updated if a branch office could not be fetched, keeping the checkpoint for --resume.
+    """
     try:
         logger.info("Starting invoice search process")
-        ids_sucursales = []
         headers_ghl = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -388,183 +832,165 @@ def search_invoices():
             "authorization": os.getenv("DUX_API_KEY")
         }
 
-        logger.debug("Fetching branch offices from DUX API")
-        url_sucursales = f'https://erp.duxsoftware.com.ar/WSERP/rest/services/sucursales?idEmpresa={os.getenv("DUX_ID_EMPRESA")}'
-        try:
-            response_sucursales = requests.request("GET", url_sucursales, headers=headers_dux)
-            log_api_request("GET", url_sucursales, headers_dux, response=response_sucursales)
-
-            if not response_sucursales.ok:
-                raise Exception(
-                    f"Failed to fetch branch offices. Status code: {response_sucursales.status_code}, Response: {response_sucursales.text}")
-
-            for i in response_sucursales.json():
-                ids_sucursales.append(i['id'])
-
-            logger.info(f"Found {len(ids_sucursales)} branch offices")
-        except Exception as e:
-            log_api_request("GET", url_sucursales, headers_dux, error=e)
-            raise
+        # id -> name, loaded once (from the local cache on warm runs)
+        sucursales = get_branch_catalog()
+        ids_sucursales = list(sucursales)
+        logger.info(f"Found {len(ids_sucursales)} branch offices")
 
-        url_facturas = "https://erp.duxsoftware.com.ar/WSERP/rest/services/facturas"
-        today = datetime.now()
-        today_string_dux = datetime.strftime(today, "%Y-%m-%d")
-        logger.debug(f"Searching invoices for date: {today_string_dux}")
+        url_facturas = f"{get_dux_api_base_url()}/facturas"
+        logger.debug(f"Searching invoices from {checkpoint.date_from} to {checkpoint.date_to}")
+        branch_offsets = checkpoint.data["invoices"]["branches"]
 
         total_invoices_processed = 0
         successful_updates = 0
-        limit = 50  # Number of results per page
+        skipped_updates = 0
+        older_skipped = 0
+        branch_workers = max(1, int(os.getenv("DUX_BRANCH_WORKERS", DEFAULT_BRANCH_WORKERS)))
+        branch_stats = {item: {"pages": 0, "invoices": 0, "seconds": 0.0} for item in ids_sucursales}
+        invoice_pages = queue.Queue()
+        # id_cliente -> (sort key, invoice, branch office name) of the invoice that will be written to GHL,
+        # and str(id_cliente) -> id of the invoice already written, starting from an interrupted run
+        latest_invoices = {}
+        written_invoices = {}
+        for event in checkpoint.read_events():
+            if "written" in event:
+                written_invoices[event["written"]] = event["invoice"]
+                continue
+            j = event["latest"]
+            invoice_key = get_invoice_sort_key(j)
+            latest_invoice = latest_invoices.get(j["id_cliente"])
+            if latest_invoice is None or invoice_key > latest_invoice[0]:
+                latest_invoices[j["id_cliente"]] = (invoice_key, j, event["sucursal"])
+        contact_ids = {}
+        invoiced_clients = set()
+        failed_branches = []
+
+        # Branches are fetched in parallel under the shared DUX rate limit; every page is
+        # queued as soon as it arrives and processed here while the other branches keep fetching
+        with ThreadPoolExecutor(max_workers=branch_workers) as executor:
+            pending_branches = 0
+            for index, item in enumerate(ids_sucursales):
+                start_offset = branch_offsets.get(str(item), 0)
+                if start_offset == "done":
+                    logger.debug(f"Branch office {item} already processed, skipping")
+                    continue
+                executor.submit(fetch_branch_invoices, index, item, url_facturas, headers_dux, checkpoint.date_from,
+                                checkpoint.date_to, invoice_pages, branch_stats[item], start_offset)
+                pending_branches += 1
+
+            while pending_branches > 0:
+                message, index, item, offset, facturas = invoice_pages.get()
+                if message == "end":
+                    pending_branches -= 1
+                    # offset is None when a page failed, the branch office is then fetched again on --resume
+                    if offset is None and item not in failed_branches:
+                        failed_branches.append(item)
+                    elif item not in failed_branches:
+                        branch_offsets[str(item)] = "done"
+                        checkpoint.save()
+                    continue
 
-        for index, item in enumerate(ids_sucursales):
-            try:
-                logger.debug(f"Processing branch office {index + 1}/{len(ids_sucursales)}")
-                offset = 0
-                has_more_results = True
-
-                while has_more_results:
-                    params = {
-                        "fechaDesde": today_string_dux,
-                        "fechaHasta": today_string_dux,
-                        "idEmpresa": os.getenv("DUX_ID_EMPRESA"),
-                        "idSucursal": item,
-                        "limit": limit,
-                        "offset": offset
-                    }
+                try:
+                    page_events = []
+                    for j in facturas:
+                        total_invoices_processed += 1
+                        invoiced_clients.add(j["id_cliente"])
+                        try:
+                            # Only the latest invoice of each client is written, the others would be overwritten
+                            invoice_key = get_invoice_sort_key(j)
+                            latest_invoice = latest_invoices.get(j["id_cliente"])
+                            if latest_invoice is None or invoice_key > latest_invoice[0]:
+                                nombre_sucursal = sucursales[item]
+                                latest_invoices[j["id_cliente"]] = (invoice_key, j, nombre_sucursal)
+                                page_events.append({"latest": j, "sucursal": nombre_sucursal})
+                            # Resolve the contact while the remaining pages are still being fetched
+                            if j["id_cliente"] not in contact_ids:
+                                contact_ids[j["id_cliente"]] = get_contact_id(j["id_cliente"])
+                        except Exception as e:
+                            logger.error(f"Error processing invoice {j['id']}: {str(e)}")
+                            continue
+
+                    # The page's invoices are logged before its offset moves past them. After a failed
+                    # page the offset stays there, so --resume fetches the branch again from that page.
+                    checkpoint.append_events(page_events)
+                    if item not in failed_branches:
+                        branch_offsets[str(item)] = offset + INVOICES_PAGE_SIZE
+                        checkpoint.save()
 
-                    time.sleep(5)  # Rate limiting
-                    try:
-                        response_facturas = requests.request("GET", url_facturas, headers=headers_dux, params=params)
-                        log_api_request("GET", url_facturas, headers_dux, params, response=response_facturas)
-
-                        if not response_facturas.ok:
-                            logger.error(
-                                f"Failed to fetch invoices for branch office {item}. Status code: {response_facturas.status_code}, Response: {response_facturas.text}")
-                            break
-
-                        response_data = response_facturas.json()
-                        facturas = response_data['results']
-                        total_results = response_data.get('total', 0)
-                        
-                        logger.debug(f"Found {len(facturas)} invoices for branch office {item} (offset: {offset}, total: {total_results})")
-
-                        for j in facturas:
-                            total_invoices_processed += 1
-                            try:
-                                search_contact_result = search_contact_by_id_cliente_dux(j["id_cliente"])
-                                if len(search_contact_result['contacts']) > 0:
-                                    url_update_contact = f"https://services.leadconnectorhq.com/contacts/{search_contact_result['contacts'][0]['id']}"
-                                    fecha = datetime.strptime(j["fecha_comp"], "%b %d, %Y %I:%M:%S %p")
-                                    fecha_formateada = fecha.strftime("%Y/%m/%d")
-                                    logger.debug(
-                                        f"Updating contact for invoice {j['id']} from branch office {response_sucursales.json()[index]['sucursal']}")
-
-                                    payload_update_contact = {
-                                        "customFields": [
-                                            {
-                                                "key": "id_factura_dux",
-                                                "field_value": j["id"]
-                                            },
-                                            {
-                                                "key": "numero_punto_venta_dux",
-                                                "field_value": j["nro_pto_vta"]
-                                            },
-                                            {
-                                                "key": "id_personal_dux",
-                                                "field_value": j["id_personal"]
-                                            },
-                                            {
-                                                "key": "id_vendedor_dux",
-                                                "field_value": j["id_vendedor"]
-                                            },
-                                            {
-                                                "key": "tipo_comprobante_dux",
-                                                "field_value": j["tipo_comp"]
-                                            },
-                                            {
-                                                "key": "numero_comprobante_dux",
-                                                "field_value": j["nro_comp"]
-                                            },
-                                            {
-                                                "key": "fecha_comprobante_dux",
-                                                "field_value": fecha_formateada
-                                            },
-                                            {
-                                                "key": "monto_sin_iva_dux",
-                                                "field_value": j["monto_gravado"]
-                                            },
-                                            {
-                                                "key": "monto_total_dux",
-                                                "field_value": j["total"]
-                                            },
-                                            {
-                                                "key": "nombre_sucursal_dux",
-                                                "field_value": response_sucursales.json()[index]["sucursal"]
-                                            },
-                                            {
-                                                "key": "tiene_cobro",
-                                                "field_value": "SI" if j["detalles_cobro"] else "NO"
-                                            },
-                                            {
-                                                "key": "presupuesto_numero_dux",
-                                                "field_value": j["presupuesto"][0]["nro_presupuesto"] if j[
-                                                    "presupuesto"] else ""
-                                            },
-                                            {
-                                                "key": "presupuesto_estado_dux",
-                                                "field_value": j["presupuesto"][0]["estado"] if j["presupuesto"] else ""
-                                            }
-                                        ]
-                                    }
-
-                                    for producto in j["detalles"]:
-                                        if "COMODATO" in producto["item"]:
-                                            payload_update_contact["customFields"].append({
-                                                "key": "contrata_comodato_dux",
-                                                "value": "SI"
-                                            })
-                                        else:
-                                            payload_update_contact["customFields"].append({
-                                                "key": "contrata_comodato_dux",
-                                                "value": "NO"
-                                            })
-
-                                    try:
-                                        response_update_contact = requests.request("PUT", url_update_contact,
-                                                                               headers=headers_ghl,
-                                                                               data=json.dumps(payload_update_contact))
-                                        log_api_request("PUT", url_update_contact, headers_ghl, payload_update_contact,
-                                                        response=response_update_contact)
-
-                                        if response_update_contact.ok:
-                                            successful_updates += 1
-                                            logger.debug(f"Successfully updated contact for invoice {j['id']}")
-                                        else:
-                                            logger.error(
-                                                f"Failed to update contact for invoice {j['id']}. Status code: {response_update_contact.status_code}, Response: {response_update_contact.text}")
-                                    except Exception as e:
-                                        log_api_request("PUT", url_update_contact, headers_ghl, payload_update_contact, error=e)
-                                        logger.error(f"Error updating contact for invoice {j['id']}: {str(e)}")
-                                        continue
-
-                            except Exception as e:
-                                logger.error(f"Error processing invoice {j['id']}: {str(e)}")
-                                continue
-
-                        # Check if we need to fetch more results
-                        offset += limit
-                        has_more_results = offset < total_results
+                except Exception as e:
+                    logger.error(f"Error processing branch office {item}: {str(e)}")
+                    failed_branches.append(item)
+                    continue
 
-                    except Exception as e:
-                        log_api_request("GET", url_facturas, headers_dux, params, error=e)
-                        logger.error(f"Error fetching invoices for branch office {item}: {str(e)}")
-                        break
+        logger.debug(f"Updating {len(latest_invoices)} contacts with their latest invoice")
+        payload_hashes = get_payload_hash_store()
+        latest_written = get_latest_invoice_store()
+        written_events = []
+        for id_cliente in sorted(latest_invoices, key=str):
+            invoice_key, j, nombre_sucursal = latest_invoices[id_cliente]
+            # A newer invoice fetched on --resume is written even if an older one already was
+            if written_invoices.get(str(id_cliente)) == j["id"]:
+                continue
+            contact_id = contact_ids[id_cliente] if id_cliente in contact_ids else get_contact_id(id_cliente)
+            sort_key = format_invoice_sort_key(invoice_key)
+            try:
+                if contact_id is None:
+                    written = True
+                    continue
+                payload_update_contact = build_invoice_payload(j, nombre_sucursal)
+                payload_hash = hash_payload({"contact_id": contact_id, "payload": payload_update_contact})
+                with latest_written.client_lock(id_cliente):
+                    # Windows of a backfill finish in any order, the contact keeps the newest invoice
+                    if latest_written.is_older(id_cliente, sort_key):
+                        older_skipped += 1
+                        written = True
+                        logger.debug(f"Skipping invoice {j['id']}, the contact already holds a newer one")
+                        continue
+                    if payload_hashes.is_unchanged("invoice", j["id"], payload_hash):
+                        skipped_updates += 1
+                        written = True
+                        latest_written.record(id_cliente, sort_key, j["id"])
+                        logger.debug(f"Skipping unchanged update for invoice {j['id']}")
+                        continue
 
+                    logger.debug(f"Updating contact for invoice {j['id']} from branch office {nombre_sucursal}")
+                    written = update_contact_with_invoice(j, contact_id, payload_update_contact, headers_ghl)
+                    if written:
+                        successful_updates += 1
+                        payload_hashes.record("invoice", j["id"], payload_hash)
+                        latest_written.record(id_cliente, sort_key, j["id"])
             except Exception as e:
-                logger.error(f"Error processing branch office {item}: {str(e)}")
+                written = False
+                logger.error(f"Error processing invoice {j['id']}: {str(e)}")
                 continue
-
+            finally:
+                # Failed updates are not logged so --resume retries them
+                if written:
+                    written_events.append({"written": str(id_cliente), "invoice": j["id"]})
+                if len(written_events) >= CHECKPOINT_SAVE_INTERVAL:
+                    checkpoint.append_events(written_events)
+                    written_events = []
+        checkpoint.append_events(written_events)
+
+        for item, stats in branch_stats.items():
+            logger.info(
+                f"Branch office {item}: {stats['invoices']} invoices in {stats['pages']} pages, fetched in {stats['seconds']:.2f}s")
         logger.info(
-            f"Invoice search process completed. Total invoices processed: {total_invoices_processed}, Successful updates: {successful_updates}")
+            f"Invoice search process completed. Total invoices processed: {total_invoices_processed}, "
+            f"Contacts updated: {successful_updates}, PUTs avoided: {total_invoices_processed - len(invoiced_clients)}, "
+            f"Unchanged skipped: {skipped_updates}, Older than the contact's invoice: {older_skipped}")
+        get_contact_cache().log_stats()
+
+        metrics = get_metrics()
+        metrics.increment("rows_processed", total_invoices_processed, phase="invoices")
+        metrics.increment("ghl_writes", successful_updates, kind="invoice")
+        metrics.increment("ghl_writes_skipped", skipped_updates, kind="invoice")
+        metrics.increment("ghl_writes_skipped", older_skipped, kind="older_invoice")
+
+        if failed_branches:
+            raise Exception(
+                f"Invoices of branch offices {', '.join(str(item) for item in failed_branches)} could not be "
+                f"fetched, run again with --resume to fetch them")
 
     except Exception as e:
         error_details = traceback.format_exc()
@@ -574,10 +1000,118 @@ def search_invoices():
         raise
 
 
+def fetch_branch_invoices(index, item, url_facturas, headers_dux, date_from, date_to, invoice_pages, stats,
+                          start_offset=0, limit=INVOICES_PAGE_SIZE):
+    """
+    Page through a branch office's invoices from start_offset, putting ("page", index, item, offset, facturas)
+    on invoice_pages for every page and ("end", index, item, offset, None) once the branch is done.
+    The end offset is None if a page could not be fetched.
+    """
+    start = time.perf_counter()
+    offset = start_offset
+    completed = False
+    params = None
+    try:
+        while True:
+            params = {
+                "fechaDesde": date_from,
+                "fechaHasta": date_to,
+                "idEmpresa": os.getenv("DUX_ID_EMPRESA"),
+                "idSucursal": item,
+                "limit": limit,
+                "offset": offset
+            }
+
+            response_facturas = get_http_client().request("GET", url_facturas, headers=headers_dux, params=params)
+            log_api_request("GET", url_facturas, headers_dux, params, response=response_facturas)
+
+            if not response_facturas.ok:
+                logger.error(
+                    f"Failed to fetch invoices for branch office {item}. Status code: {response_facturas.status_code}, Response: {response_facturas.text}")
+                break
+
+            response_data = response_facturas.json()
+            facturas = response_data['results']
+            total_results = response_data.get('total', 0)
+
+            logger.debug(f"Found {len(facturas)} invoices for branch office {item} (offset: {offset}, total: {total_results})")
+            stats["pages"] += 1
+            stats["invoices"] += len(facturas)
+            if facturas:
+                invoice_pages.put(("page", index, item, offset, facturas))
+
+            # Check if we need to fetch more results
+            offset += limit
+            if offset >= total_results:
+                completed = True
+                break
+
+    except Exception as e:
+        log_api_request("GET", url_facturas, headers_dux, params, error=e)
+        logger.error(f"Error fetching invoices for branch office {item}: {str(e)}")
+    finally:
+        stats["seconds"] = time.perf_counter() - start
+        invoice_pages.put(("end", index, item, offset if completed else None, None))
+
+
+def get_invoice_sort_key(j):
+    """
+    Order invoices of the same client by date, then by id, so the latest one wins deterministically
+    """
+    return parse_fecha_comp(j["fecha_comp"]), str(j["id"]).zfill(20)
+
+
+def format_invoice_sort_key(invoice_key):
+    """
+    Invoice sort key as text that orders the same way, as stored in the state database
+    """
+    fecha, invoice_id = invoice_key
+    return f"{fecha:%Y-%m-%d %H:%M:%S} {invoice_id}"
+
+
+def build_invoice_payload(j, nombre_sucursal):
+    """
+    Build the GHL contact update payload for an invoice
+    """
+    return transform_invoice(j, {"nombre_sucursal": nombre_sucursal})
+
+
+def update_contact_with_invoice(j, contact_id, payload_update_contact, headers_ghl):
+    """
+    Send an invoice payload to the client's GHL contact. Returns True if the contact was updated.
+    """
+    url_update_contact = f"{get_ghl_api_base_url()}/contacts/{contact_id}"
+    try:
+        response_update_contact = get_http_client().request(
+            "PUT", url_update_contact, headers=headers_ghl,
+            data=json.dumps(payload_update_contact))
+        log_api_request("PUT", url_update_contact, headers_ghl, payload_update_contact,
+                        response=response_update_contact)
+
+        if response_update_contact.ok:
+            logger.debug(f"Successfully updated contact for invoice {j['id']}")
+            return True
+        elif response_update_contact.status_code in (400, 404):
+            # The cached contact may have been deleted or merged in GHL
+            get_contact_cache().delete(j["id_cliente"])
+            get_contact_index().delete(os.getenv("GHL_LOCATION_ID"), j["id_cliente"])
+            get_latest_invoice_store().delete(j["id_cliente"])
+            logger.error(
+                f"Failed to update contact for invoice {j['id']}. Status code: {response_update_contact.status_code}, Response: {response_update_contact.text}")
+        else:
+            logger.error(
+                f"Failed to update contact for invoice {j['id']}. Status code: {response_update_contact.status_code}, Response: {response_update_contact.text}")
+    except Exception as e:
+        log_api_request("PUT", url_update_contact, headers_ghl, payload_update_contact, error=e)
+        logger.error(f"Error updating contact for invoice {j['id']}: {str(e)}")
+
+    return False
+
+
 def search_contact_by_id_cliente_dux(id_cliente_dux, phone="", email=""):
     try:
         logger.debug(f"Searching contact by DUX ID: {id_cliente_dux}, Phone: {phone}, Email: {email}")
-        url = "https://services.leadconnectorhq.com/contacts/search"
+        url = f"{get_ghl_api_base_url()}/contacts/search"
         headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -619,7 +1153,7 @@ def search_contact_by_id_cliente_dux(id_cliente_dux, phone="", email=""):
         }
 
         try:
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = get_http_client().request("POST", url, headers=headers, data=json.dumps(payload))
             log_api_request("POST", url, headers, payload, response=response)
 
             if not response.ok:
@@ -640,18 +1174,15 @@ def search_contact_by_id_cliente_dux(id_cliente_dux, phone="", email=""):
         return {"contacts": []}
 
 
-def iterate_table(driver, all_clients_list):
+def iterate_table(driver):
+    """
+    Scrape the current page of the clients table and return its client rows
+    """
     try:
-        logger.debug("Opening Google Sheet 'Clientes DUX - GHL Cloud Server'")
         logger.debug("Extracting table data")
-        rows = driver.find_elements(By.TAG_NAME, "tr")
-        rows_processed = 0
-        for row in rows:
-            cols = [col.text for col in row.find_elements(By.TAG_NAME, "td")]
-            if len(cols) == 29:
-                new_cols = cols[2:]
-                all_clients_list.append(new_cols)
-                rows_processed += 1
+        # The first two cells of each row are grid controls, not client data
+        page_clients_list = [cols[2:] for cols in extract_table_rows(driver)]
+        rows_processed = len(page_clients_list)
 
         logger.info(f"Processed {rows_processed} client rows")
 
@@ -659,13 +1190,7 @@ def iterate_table(driver, all_clients_list):
             logger.warning("No rows found to process, stopping execution")
             raise NoRowsFoundException("No rows were found to process in the current page")
 
-        filename = 'clients.csv'
-        with open(filename, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerows(all_clients_list)
-
-        upsert_contacts()
-
+        return page_clients_list
 
     except NoRowsFoundException:
         # Just log the warning and re-raise, without sending email
@@ -679,6 +1204,35 @@ def iterate_table(driver, all_clients_list):
         raise
 
 
+def upsert_clients_page(page_clients_list, upsert_summary, progress_callback=None):
+    """
+    Upsert one page of client rows (csv_clients_dictionary layout) and update the run summary
+    """
+    contacts_sent, contacts_skipped = upsert_contacts(page_clients_list, progress_callback)
+
+    # The previous implementation re-sent every contact accumulated so far on each page
+    upsert_summary["pages"] += 1
+    upsert_summary["contacts_sent"] += contacts_sent
+    upsert_summary["contacts_skipped"] += contacts_skipped
+    upsert_summary["legacy_calls"] += upsert_summary["contacts_sent"] + upsert_summary["contacts_skipped"]
+
+    metrics = get_metrics()
+    metrics.increment("rows_processed", len(page_clients_list), phase="clients")
+    metrics.increment("ghl_writes", contacts_sent, kind="contact")
+    metrics.increment("ghl_writes_skipped", contacts_skipped, kind="contact")
+
+
+def log_upsert_summary(upsert_summary):
+    """
+    Log how many upsert calls were made compared with re-sending the accumulated list per page.
+    """
+    saved_calls = upsert_summary["legacy_calls"] - upsert_summary["contacts_sent"]
+    logger.info(
+        f"Upsert summary. Pages: {upsert_summary['pages']}, Contacts sent: {upsert_summary['contacts_sent']}, "
+        f"Unchanged skipped: {upsert_summary['contacts_skipped']}, "
+        f"Calls with per-page re-upsert: {upsert_summary['legacy_calls']}, API calls saved: {saved_calls}")
+
+
 # Add this new custom exception class at the top level of the file, after the imports
 class NoRowsFoundException(Exception):
     """Exception raised when no rows are found to process"""
@@ -686,7 +1240,7 @@ class NoRowsFoundException(Exception):
 
 
 def search_contacts(location_id, integration_key, id_cliente_dux='', email='', phone=''):
-    url = "https://services.leadconnectorhq.com/contacts/search"
+    url = f"{get_ghl_api_base_url()}/contacts/search"
 
     payload = json.dumps({
         "locationId": location_id,
@@ -728,37 +1282,92 @@ def search_contacts(location_id, integration_key, id_cliente_dux='', email='', p
         'Version': '2021-07-28'
     }
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = get_http_client().request("POST", url, headers=headers, data=payload)
 
     print(json.dumps(response.json(), indent=2))
 
 
+def truncate_for_log(text, limit):
+    """
+    Cut text to limit characters for the debug log, noting how much was left out
+    """
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... [{len(text) - limit} more characters]"
+    return text
+
+
 def log_api_request(method, url, headers, payload=None, response=None, error=None):
     """
-    Log API request and response details
+    Log API request and response details. Nothing is serialized unless the logger emits DEBUG records.
+    Successful calls are sampled (LOG_API_SAMPLE_RATE) and their bodies truncated (LOG_API_BODY_LIMIT),
+    failed calls are always logged in full.
     """
     try:
-        # Mask sensitive information in headers
-        masked_headers = headers.copy()
-        if 'Authorization' in masked_headers:
-            masked_headers['Authorization'] = 'Bearer [MASKED]'
-
-        # Log request details
-        logger.debug(f"API Request - Method: {method}, URL: {url}")
-        logger.debug(f"API Request - Headers: {json.dumps(masked_headers, indent=2)}")
-        if payload:
-            logger.debug(f"API Request - Payload: {json.dumps(payload, indent=2)}")
-
-        # Log response or error
-        if response:
-            logger.debug(f"API Response - Status Code: {response.status_code}")
-            logger.debug(f"API Response - Body: {response.text}")
-        elif error:
+        failed = error is not None or (response is not None and not response.ok)
+        if logger.isEnabledFor(logging.DEBUG) and (
+                failed or random.random() < float(os.getenv("LOG_API_SAMPLE_RATE", DEFAULT_LOG_API_SAMPLE_RATE))):
+            body_limit = None if failed else int(os.getenv("LOG_API_BODY_LIMIT", DEFAULT_LOG_API_BODY_LIMIT))
+
+            # Mask sensitive information in headers
+            masked_headers = dict(headers)
+            if 'Authorization' in masked_headers:
+                masked_headers['Authorization'] = 'Bearer [MASKED]'
+
+            # Log request details
+            logger.debug(f"API Request - Method: {method}, URL: {url}")
+            logger.debug(f"API Request - Headers: {json.dumps(masked_headers)}")
+            if payload:
+                logger.debug(f"API Request - Payload: {truncate_for_log(json.dumps(payload, ensure_ascii=False), body_limit)}")
+
+            if response is not None:
+                logger.debug(f"API Response - Status Code: {response.status_code}")
+                logger.debug(f"API Response - Body: {truncate_for_log(response.text, body_limit)}")
+
+        if error is not None:
             logger.error(f"API Error: {str(error)}")
 
     except Exception as e:
         logger.error(f"Error logging API request: {str(e)}")
 
 
+def parse_date(value):
+    """
+    argparse type for YYYY-MM-DD dates
+    """
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r}, expected YYYY-MM-DD")
+    return value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync DUX clients and invoices into GHL")
+    parser.add_argument("--force", action="store_true",
+                        help="send every payload to GHL even if it matches the last one sent")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last interrupted run from its checkpoint")
+    parser.add_argument("--spill-csv", metavar="PATH",
+                        help="also append every client row to this CSV file as it is processed")
+    parser.add_argument("--from", dest="date_from", type=parse_date, metavar="YYYY-MM-DD",
+                        help="backfill from this date instead of syncing today")
+    parser.add_argument("--to", dest="date_to", type=parse_date, metavar="YYYY-MM-DD",
+                        help="last date of the backfill (defaults to --from)")
+    parser.add_argument("--window", choices=("day", "week"), default="day",
+                        help="size of the backfill windows (default: day)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="backfill windows processed concurrently (default: 1)")
+    args = parser.parse_args()
+    if args.date_to and not args.date_from:
+        parser.error("--to requires --from")
+    if args.date_to and args.date_to < args.date_from:
+        parser.error("--to must not be before --from")
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    run_status = main(force=args.force, spill_csv=args.spill_csv, resume=args.resume, date_from=args.date_from,
+                      date_to=args.date_to, window=args.window, workers=args.workers)
+    if run_status == "failed":
+        sys.exit(1)
@@ -0,0 +1,145 @@
+"""
+DUX WSERP REST API: client export, used instead of scraping listaClienteBeta.faces
+when DUX_CLIENTS_BACKEND=api, and the branch office catalog
+"""
+import logging
+import os
+
+from http_client import get_http_client
+from state_store import get_branch_cache
+
+logger = logging.getLogger('DUXScript')
+
+DEFAULT_DUX_API_BASE_URL = "https://erp.duxsoftware.com.ar/WSERP/rest/services"
+
+# Columns of csv_clients_dictionary in order, with the API keys that may carry each value.
+# The first key present in the API response wins.
+CLIENT_API_FIELDS = [
+    ("id", ("id_cliente", "id")),
+    ("fecha_creacion", ("fecha_creacion", "fecha_alta")),
+    ("cliente", ("cliente", "razon_social", "nombre")),
+    ("categoria_fiscal", ("categoria_fiscal",)),
+    ("tipo_documento", ("tipo_documento", "tipo_doc")),
+    ("numero_documento", ("numero_documento", "nro_doc")),
+    ("cuit/cuil", ("cuit", "cuit_cuil")),
+    ("cobrador", ("cobrador",)),
+    ("tipo_cliente", ("tipo_cliente",)),
+    ("persona_contacto", ("persona_contacto",)),
+    ("no_editable", ("no_editable",)),
+    ("lugar_entrega_por_defecto", ("lugar_entrega_por_defecto",)),
+    ("tipo_comprobante_por_defecto", ("tipo_comprobante_por_defecto",)),
+    ("lista_precio_por_defecto", ("lista_precio_por_defecto",)),
+    ("habilitado", ("habilitado",)),
+    ("nombre_de_fantasia", ("nombre_fantasia", "nombre_de_fantasia")),
+    ("codigo", ("codigo", "codigo_postal")),
+    ("correo_electronico", ("correo_electronico", "email")),
+    ("vendedor", ("vendedor",)),
+    ("provincia", ("provincia",)),
+    ("localidad", ("localidad",)),
+    ("barrio", ("barrio",)),
+    ("domicilio", ("domicilio", "direccion")),
+    ("telefono", ("telefono",)),
+    ("celular", ("celular",)),
+    ("zona", ("zona",)),
+    ("condicion_pago", ("condicion_pago",)),
+]
+
+
+def get_dux_api_base_url():
+    """
+    Return the DUX REST API base URL, overridable with DUX_API_BASE_URL (e.g. to point at a local stub server)
+    """
+    return os.getenv("DUX_API_BASE_URL", DEFAULT_DUX_API_BASE_URL).rstrip("/")
+
+
+def format_client_value(value):
+    """
+    Render an API value the way the clients grid shows it
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "SI" if value else "NO"
+    return str(value)
+
+
+def map_client(client):
+    """
+    Map a DUX API client object onto a row in csv_clients_dictionary layout
+    """
+    row = []
+    for _, keys in CLIENT_API_FIELDS:
+        value = next((client[key] for key in keys if key in client), None)
+        row.append(format_client_value(value))
+    return row
+
+
+def fetch_clients(date_from, date_to, limit=50, start_offset=0):
+    """
+    Page through the DUX clients endpoint from start_offset and yield one list of mapped rows per page
+    """
+    url = f"{get_dux_api_base_url()}/clientes"
+    headers = {
+        "accept": "application/json",
+        "authorization": os.getenv("DUX_API_KEY")
+    }
+    offset = start_offset
+    has_more_results = True
+
+    while has_more_results:
+        params = {
+            "idEmpresa": os.getenv("DUX_ID_EMPRESA"),
+            "fechaDesde": date_from,
+            "fechaHasta": date_to,
+            "limit": limit,
+            "offset": offset
+        }
+
+        logger.debug(f"API Request - Method: GET, URL: {url}, offset: {offset}")
+        response = get_http_client().request("GET", url, headers=headers, params=params)
+        logger.debug(f"API Response - Status Code: {response.status_code}")
+
+        if not response.ok:
+            raise Exception(
+                f"Failed to fetch clients. Status code: {response.status_code}, Response: {response.text}")
+
+        response_data = response.json()
+        clients = response_data.get("results", [])
+        total_results = response_data.get("total", response_data.get("paging", {}).get("total", 0))
+        logger.debug(f"Found {len(clients)} clients (offset: {offset}, total: {total_results})")
+
+        if clients:
+            yield [map_client(client) for client in clients]
+
+        offset += limit
+        has_more_results = bool(clients) and offset < total_results
+
+
+def get_branch_catalog():
+    """
+    Return the company's branch offices as {id: name} in API order, from the local cache while it is
+    fresh (BRANCH_CACHE_TTL_HOURS) and from the /sucursales endpoint otherwise
+    """
+    id_empresa = os.getenv("DUX_ID_EMPRESA")
+    branch_cache = get_branch_cache()
+    branches = branch_cache.get(id_empresa)
+    if branches is not None:
+        logger.debug(f"Using {len(branches)} cached branch offices")
+        return branches
+
+    url = f"{get_dux_api_base_url()}/sucursales"
+    headers = {
+        "accept": "application/json",
+        "authorization": os.getenv("DUX_API_KEY")
+    }
+    logger.debug(f"API Request - Method: GET, URL: {url}")
+    response = get_http_client().request("GET", url, headers=headers, params={"idEmpresa": id_empresa})
+    logger.debug(f"API Response - Status Code: {response.status_code}")
+
+    if not response.ok:
+        raise Exception(
+            f"Failed to fetch branch offices. Status code: {response.status_code}, Response: {response.text}")
+
+    branches = {branch["id"]: branch["sucursal"] for branch in response.json()}
+    branch_cache.set(id_empresa, branches)
+    return branches
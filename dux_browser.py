@@ -0,0 +1,540 @@
+"""
+Selenium helpers shared by main.py and dux-ghl-contacts-integration.py
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import get_metrics
+from selenium import webdriver
+from selenium.common.exceptions import SessionNotCreatedException, TimeoutException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support.ui import Select, WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+logger = logging.getLogger('DUXScript')
+
+DUX_BASE_URL = "https://erp.duxsoftware.com.ar/"
+CLIENTS_PAGE_URL = f"{DUX_BASE_URL}pages/configuracion/cliente/listaClienteBeta.faces"
+
+# Session cookies saved after a login, reused by later runs until DUX expires them
+DEFAULT_SESSION_FILE = "state/dux_session.json"
+# chromedriver path resolved by webdriver-manager, reused so runs skip its online version check
+DEFAULT_DRIVER_PATH_FILE = "state/chromedriver_path"
+
+# Number of td cells in a client row of listaClienteBeta.faces
+CLIENT_ROW_COLUMNS = 29
+
+# Reads every row of the page in a single round trip. innerText mirrors WebElement.text
+# closely enough for the plain text cells of the clients grid.
+EXTRACT_TABLE_SCRIPT = """
+const columns = arguments[0];
+const rows = [];
+for (const tr of document.getElementsByTagName('tr')) {
+    const cells = tr.getElementsByTagName('td');
+    if (cells.length !== columns) {
+        continue;
+    }
+    const row = [];
+    for (const td of cells) {
+        row.push((td.innerText || '').trim());
+    }
+    rows.push(row);
+}
+return rows;
+"""
+
+
+def extract_table_rows_per_cell(driver, column_count=CLIENT_ROW_COLUMNS):
+    """
+    Extract table rows reading each cell through WebDriver (one round trip per cell)
+    """
+    table_rows = []
+    for row in driver.find_elements(By.TAG_NAME, "tr"):
+        cols = [col.text for col in row.find_elements(By.TAG_NAME, "td")]
+        if len(cols) == column_count:
+            table_rows.append(cols)
+    return table_rows
+
+
+def extract_table_rows(driver, column_count=CLIENT_ROW_COLUMNS):
+    """
+    Extract every table row with exactly column_count cells using a single in-page script.
+    Falls back to the per-cell WebDriver path if the script fails or returns something unexpected.
+    """
+    try:
+        table_rows = driver.execute_script(EXTRACT_TABLE_SCRIPT, column_count)
+        if isinstance(table_rows, list) and all(len(row) == column_count for row in table_rows):
+            logger.debug(f"Bulk extraction returned {len(table_rows)} rows")
+            return table_rows
+        logger.warning("Bulk table extraction returned an unexpected result, falling back to per-cell extraction")
+    except Exception as e:
+        logger.warning(f"Bulk table extraction failed, falling back to per-cell extraction: {str(e)}")
+
+    return extract_table_rows_per_cell(driver, column_count)
+
+
+# Default seconds to wait for any navigation step; override with DUX_WAIT_TIMEOUT or
+# per step with DUX_WAIT_TIMEOUT_<STEP> (e.g. DUX_WAIT_TIMEOUT_LOGIN=60)
+DEFAULT_WAIT_TIMEOUT = 30
+
+# True once the document is loaded and neither PrimeFaces nor jQuery have AJAX requests in flight
+AJAX_IDLE_SCRIPT = """
+if (document.readyState !== 'complete') {
+    return false;
+}
+if (window.PrimeFaces && PrimeFaces.ajax && PrimeFaces.ajax.Queue && !PrimeFaces.ajax.Queue.isEmpty()) {
+    return false;
+}
+if (window.jQuery && jQuery.active > 0) {
+    return false;
+}
+return true;
+"""
+
+
+def get_wait_timeout(step=None):
+    """
+    Return the wait timeout in seconds for a navigation step
+    """
+    default_timeout = float(os.getenv("DUX_WAIT_TIMEOUT", DEFAULT_WAIT_TIMEOUT))
+    if step is None:
+        return default_timeout
+    return float(os.getenv(f"DUX_WAIT_TIMEOUT_{step.upper()}", default_timeout))
+
+
+def wait_for_ajax_idle(driver, timeout):
+    """
+    Wait until the page is loaded and the PrimeFaces AJAX queue is empty
+    """
+    WebDriverWait(driver, timeout, poll_frequency=0.2).until(
+        lambda d: d.execute_script(AJAX_IDLE_SCRIPT),
+        message=f"Page did not become idle within {timeout} seconds")
+
+
+def wait_for_element(driver, by, value, timeout, clickable=False):
+    """
+    Wait for an element to be present (or clickable) and return it
+    """
+    condition = EC.element_to_be_clickable((by, value)) if clickable else EC.presence_of_element_located((by, value))
+    return WebDriverWait(driver, timeout, poll_frequency=0.2).until(
+        condition, message=f"Element {value} not found within {timeout} seconds")
+
+
+def find_table_body(driver):
+    """
+    Return the body of the clients data table, or None if it is not rendered yet
+    """
+    for selector in ("tbody.ui-datatable-data", "tbody"):
+        elements = driver.find_elements(By.CSS_SELECTOR, selector)
+        if elements:
+            return elements[0]
+    return None
+
+
+def find_first_table_row(driver):
+    """
+    Return the first row of the clients data table, or None if it has no rows yet
+    """
+    table_body = find_table_body(driver)
+    if table_body is None:
+        return None
+    rows = table_body.find_elements(By.TAG_NAME, "tr")
+    return rows[0] if rows else None
+
+
+def wait_for_table_refresh(driver, previous_first_row, timeout):
+    """
+    Wait for the AJAX update that replaces previous_first_row and for the page to become idle again.
+    PrimeFaces keeps the tbody element and rewrites its rows, so the first row is what goes stale.
+    Raises TimeoutException if the rows are not replaced, instead of scraping the same page again.
+    """
+    if previous_first_row is not None:
+        try:
+            WebDriverWait(driver, timeout, poll_frequency=0.2).until(EC.staleness_of(previous_first_row))
+        except TimeoutException:
+            raise TimeoutException(f"Table rows were not replaced within {timeout} seconds") from None
+    wait_for_ajax_idle(driver, timeout)
+
+
+def maximize_page_size(driver, selectors, timeout):
+    """
+    Switch the clients grid to the largest rows-per-page option of its paginator. Returns
+    (default rows per page, rows per page in use), or None if the grid has no rows-per-page selector.
+    """
+    select_element = selectors.find_optional("rows_per_page_select")
+    if select_element is None:
+        logger.info("Clients grid has no rows-per-page selector, keeping its default page size")
+        return None
+
+    select = Select(select_element)
+    default_rows = int(select.first_selected_option.get_attribute("value"))
+    option_rows = [int(option.get_attribute("value")) for option in select.options
+                   if option.get_attribute("value").isdigit()]
+    largest_rows = max(option_rows, default=default_rows)
+    if largest_rows > default_rows:
+        first_row = find_first_table_row(driver)
+        select.select_by_value(str(largest_rows))
+        wait_for_table_refresh(driver, first_row, timeout)
+        logger.info(f"Clients grid page size set to {largest_rows} rows (default {default_rows})")
+    return default_rows, largest_rows
+
+
+def log_page_size_savings(step_timer, page_size, rows, pages):
+    """
+    Log how many pages the larger page size avoided and the time saved, estimated from the
+    measured page loads (the page size switch counts as one load when there was a single page)
+    """
+    if page_size is None or not rows:
+        return
+    default_rows, rows_per_page = page_size
+    default_pages = math.ceil(rows / default_rows)
+    page_loads = step_timer.get_stats("Next page load") or step_timer.get_stats("Page size")
+    page_size_switch = step_timer.get_stats("Page size")
+    switch_seconds = page_size_switch[1] if page_size_switch else 0.0
+    page_load_seconds = page_loads[1] / page_loads[0] if page_loads else 0.0
+    seconds_saved = (default_pages - pages) * page_load_seconds - switch_seconds
+    logger.info(
+        f"Scraped {rows} rows in {pages} pages of {rows_per_page} rows instead of {default_pages} pages of "
+        f"{default_rows} rows. Estimated time saved: {seconds_saved:.1f}s")
+
+
+class StepTimer:
+    """
+    Collects wall-clock durations of named steps and logs a report at the end of the run.
+    Every step is also recorded in the run metrics as the step_duration timer.
+    """
+
+    def __init__(self):
+        # name -> [count, total seconds, max seconds], in first-seen order
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.steps.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        get_metrics().observe("step_duration", seconds, step=name)
+
+    def get_stats(self, name):
+        """
+        Return (count, total seconds, max seconds) of a step, or None if it never ran
+        """
+        with self.lock:
+            stats = self.steps.get(name)
+            return tuple(stats) if stats else None
+
+    def log_report(self):
+        if not self.steps:
+            return
+        total_seconds = sum(stats[1] for stats in self.steps.values())
+        logger.info("Step duration report:")
+        for name, (count, seconds, max_seconds) in self.steps.items():
+            if count == 1:
+                logger.info(f"  {name}: {seconds:.2f}s")
+            else:
+                logger.info(f"  {name}: {seconds:.2f}s over {count} runs (avg {seconds / count:.2f}s, max {max_seconds:.2f}s)")
+        logger.info(f"  Total timed: {total_seconds:.2f}s")
+
+
+# Elements the scripts interact with, by logical name, with the locators tried in order. The j_idt ids
+# are generated by JSF and differ between DUX deployments, so the known ids come first and the last
+# locators only rely on PrimeFaces classes and the page layout.
+SELECTORS = {
+    "branch_button": [
+        (By.ID, "formInicio:j_idt910"),
+        (By.ID, "formInicio:j_idt909"),
+        (By.XPATH, "//form[@id='formInicio']//button"),
+    ],
+    "date_filter_menu": [
+        (By.ID, "formCabecera:j_idt1031_label"),
+        (By.ID, "formCabecera:j_idt1030_label"),
+        (By.XPATH, "//form[@id='formCabecera']//label[contains(@class, 'ui-selectonemenu-label')]"),
+    ],
+    "date_filter_range_option": [
+        (By.ID, "formCabecera:j_idt1031_3"),
+        (By.ID, "formCabecera:j_idt1030_3"),
+        (By.CSS_SELECTOR, "li.ui-selectonemenu-item[id^='formCabecera:'][id$='_3']"),
+    ],
+    "date_from_input": [
+        (By.ID, "formCabecera:j_idt1041_input"),
+        (By.ID, "formCabecera:j_idt1040_input"),
+        (By.XPATH, "(//form[@id='formCabecera']//span[contains(@class, 'ui-calendar')]/input)[1]"),
+    ],
+    "date_to_input": [
+        (By.ID, "formCabecera:j_idt1047_input"),
+        (By.ID, "formCabecera:j_idt1046_input"),
+        (By.XPATH, "(//form[@id='formCabecera']//span[contains(@class, 'ui-calendar')]/input)[2]"),
+    ],
+    "rows_per_page_select": [
+        (By.CSS_SELECTOR, "select.ui-paginator-rpp-options"),
+    ],
+    "next_page_button": [
+        (By.CSS_SELECTOR, "a.ui-paginator-next"),
+        (By.XPATH, "/html/body/div[2]/div[4]/div/div[2]/div/form/div/div[5]/a[3]"),
+    ],
+}
+
+# JSF form each element belongs to. Once the page has settled for VIEW_PROBE_SECONDS without the form,
+# the browser is on another view and the element lookup fails without waiting for its full timeout.
+# branch_button is not probed: while the login POST is pending the login page still looks settled.
+ELEMENT_FORMS = {
+    "date_filter_menu": "formCabecera",
+    "date_filter_range_option": "formCabecera",
+    "date_from_input": "formCabecera",
+    "date_to_input": "formCabecera",
+}
+VIEW_PROBE_SECONDS = 2
+
+# Ids of the JSF generated elements on the page, listed in the diagnostic of a missing element
+PAGE_JSF_IDS_SCRIPT = """
+return Array.from(document.querySelectorAll("[id*='j_idt']")).map(e => e.id).slice(0, 50);
+"""
+
+
+class ElementNotFoundError(Exception):
+    """Exception raised when a DUX page element cannot be found with any of its locators"""
+    pass
+
+
+class SelectorRegistry:
+    """
+    Finds the elements in SELECTORS for one browser session, trying every locator of an element on
+    each poll. The locator that matched is cached, by id when the element has one, so later lookups
+    go straight to it.
+    """
+
+    def __init__(self, driver, selectors=None):
+        self.driver = driver
+        self.selectors = selectors or SELECTORS
+        self.resolved = {}
+
+    def find(self, name, timeout, clickable=False):
+        """
+        Return the element, raising ElementNotFoundError with a diagnostic if no locator matches
+        within timeout seconds, DUX has sent the browser back to the login page or the page
+        settled on a view without the element's form
+        """
+        locators = self.selectors[name]
+        form_id = ELEMENT_FORMS.get(name)
+        started_at = time.monotonic()
+        if name in self.resolved:
+            locators = [self.resolved[name]] + [locator for locator in locators if locator != self.resolved[name]]
+
+        def locate(driver):
+            for locator in locators:
+                elements = driver.find_elements(*locator)
+                if elements and (not clickable or (elements[0].is_displayed() and elements[0].is_enabled())):
+                    return locator, elements[0]
+            if name != "branch_button" and is_login_page(driver):
+                raise ElementNotFoundError(self.describe_missing(name, locators, "not found, the DUX session has expired"))
+            if (form_id and time.monotonic() - started_at > VIEW_PROBE_SECONDS
+                    and not driver.find_elements(By.ID, form_id) and driver.execute_script(AJAX_IDLE_SCRIPT)):
+                raise ElementNotFoundError(
+                    self.describe_missing(name, locators, f"not found, the page has no {form_id} form"))
+            return False
+
+        try:
+            locator, element = WebDriverWait(self.driver, timeout, poll_frequency=0.2).until(locate)
+        except TimeoutException:
+            raise ElementNotFoundError(self.describe_missing(name, locators, f"not found within {timeout} seconds"))
+
+        if name not in self.resolved:
+            if len(self.selectors[name]) > 1 and locator == self.selectors[name][-1]:
+                # None of the known locators matched, the page has probably changed
+                logger.warning(f"Element {name} resolved with its last-resort locator {locator[1]}")
+            element_id = element.get_attribute("id")
+            self.resolved[name] = (By.ID, element_id) if element_id else locator
+            logger.debug(f"Element {name} resolved to {self.resolved[name][1]}")
+        return element
+
+    def find_optional(self, name):
+        """
+        Return the element if a locator matches right now, without waiting, or None
+        """
+        for locator in self.selectors[name]:
+            elements = self.driver.find_elements(*locator)
+            if elements:
+                return elements[0]
+        return None
+
+    def describe_missing(self, name, locators, reason):
+        try:
+            page_ids = self.driver.execute_script(PAGE_JSF_IDS_SCRIPT)
+            location = f"{self.driver.current_url} ({self.driver.title})"
+        except Exception as e:
+            page_ids = []
+            location = f"unknown page ({str(e)})"
+        return (f"Element {name} {reason} on {location}. "
+                f"Locators tried: {', '.join(value for _, value in locators)}. "
+                f"JSF ids on the page: {', '.join(page_ids) or 'none'}")
+
+
+def write_file_atomically(path, content):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+def get_chromedriver_path(refresh=False):
+    """
+    Return the chromedriver executable: CHROMEDRIVER_PATH if set, otherwise the path cached by an earlier run,
+    otherwise the one installed by webdriver-manager (which goes online) and cache it.
+    refresh skips the cached path, e.g. once Chrome has updated past the cached driver.
+    """
+    driver_path = os.getenv("CHROMEDRIVER_PATH")
+    if driver_path:
+        return driver_path
+
+    if refresh:
+        if os.path.exists(DEFAULT_DRIVER_PATH_FILE):
+            os.remove(DEFAULT_DRIVER_PATH_FILE)
+    elif os.path.exists(DEFAULT_DRIVER_PATH_FILE):
+        with open(DEFAULT_DRIVER_PATH_FILE, "r", encoding="utf-8") as file:
+            driver_path = file.read().strip()
+        if driver_path and os.path.exists(driver_path):
+            logger.debug(f"Using cached chromedriver at {driver_path}")
+            return driver_path
+        logger.debug("Cached chromedriver path is missing, installing it again")
+
+    from webdriver_manager.chrome import ChromeDriverManager
+    driver_path = ChromeDriverManager().install()
+    write_file_atomically(DEFAULT_DRIVER_PATH_FILE, driver_path)
+    return driver_path
+
+
+def create_chrome_driver():
+    """
+    Start the headless Chrome used to scrape DUX
+    """
+    options = Options()
+    options.add_argument('--headless')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--window-size=1920,1080')
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    try:
+        return webdriver.Chrome(service=Service(get_chromedriver_path()), options=options)
+    except SessionNotCreatedException as e:
+        # Usually Chrome updated itself and no longer matches the cached chromedriver
+        if os.getenv("CHROMEDRIVER_PATH") or not os.path.exists(DEFAULT_DRIVER_PATH_FILE):
+            raise
+        logger.warning(f"Chrome session could not be created with the cached chromedriver, installing it again: {e.msg}")
+    return webdriver.Chrome(service=Service(get_chromedriver_path(refresh=True)), options=options)
+
+
+def get_session_file():
+    """
+    Return the session cookie file (DUX_SESSION_FILE), or None if session reuse is disabled with DUX_REUSE_SESSION=0
+    """
+    if os.getenv("DUX_REUSE_SESSION", "1") == "0":
+        return None
+    return os.getenv("DUX_SESSION_FILE", DEFAULT_SESSION_FILE)
+
+
+def save_session_cookies(driver, path):
+    write_file_atomically(path, json.dumps(driver.get_cookies()))
+    logger.debug(f"DUX session cookies saved to {path}")
+
+
+def restore_session_cookies(driver, path):
+    """
+    Load the saved, unexpired session cookies into the browser. Returns False if there is nothing to restore.
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            saved_cookies = json.load(file)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable session file {path}")
+        return False
+
+    cookies = []
+    for saved_cookie in saved_cookies:
+        if saved_cookie.get("expiry") and saved_cookie["expiry"] < time.time():
+            continue
+        cookie = {key: saved_cookie[key]
+                  for key in ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite") if key in saved_cookie}
+        if "expiry" in saved_cookie:
+            cookie["expires"] = saved_cookie["expiry"]
+        cookies.append(cookie)
+    if not cookies:
+        return False
+
+    # Set through DevTools so no page has to be loaded on the DUX domain first
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+    return True
+
+
+def is_login_page(driver):
+    return bool(driver.find_elements(By.ID, "formLogin:inputUsuario"))
+
+
+def login(driver, step_timer, selectors):
+    """
+    Log into DUX with DUX_USERNAME/DUX_PASSWORD and accept the branch office selection
+    """
+    # Paso 1: Ir a la página de login
+    logger.info("Navigating to DUX login page")
+    with step_timer.step("Login page"):
+        driver.get(DUX_BASE_URL)
+        wait_for_element(driver, By.ID, "formLogin:inputUsuario", get_wait_timeout("login"))
+
+    # Paso 2: Ingresar credenciales
+    logger.debug("Entering login credentials")
+    with step_timer.step("Login"):
+        driver.find_element(By.ID, "formLogin:inputUsuario").send_keys(os.getenv("DUX_USERNAME"))
+        driver.find_element(By.ID, "formLogin:inputPassword").send_keys(os.getenv("DUX_PASSWORD"), Keys.RETURN)
+
+        logger.debug("Waiting for page load after login")
+        button_branch = selectors.find("branch_button", get_wait_timeout("login"), clickable=True)
+
+    # Paso 3: Aceptar select de sucursal
+    logger.debug("Selecting branch office")
+    with step_timer.step("Branch selection"):
+        button_branch.click()
+        WebDriverWait(driver, get_wait_timeout("branch")).until(EC.staleness_of(button_branch))
+        wait_for_ajax_idle(driver, get_wait_timeout("branch"))
+
+
+def open_dux_page(driver, step_timer, url, selectors):
+    """
+    Open a DUX page with the session saved by an earlier run, falling back to a full login when
+    there is no saved session or DUX has expired it
+    """
+    session_file = get_session_file()
+    if session_file and restore_session_cookies(driver, session_file):
+        with step_timer.step("Session restore"):
+            driver.get(url)
+            session_valid = not is_login_page(driver)
+        if session_valid:
+            logger.info("Reusing saved DUX session, login skipped")
+            return
+        logger.info("Saved DUX session has expired, logging in again")
+
+    login(driver, step_timer, selectors)
+    if session_file:
+        save_session_cookies(driver, session_file)
+    driver.get(url)
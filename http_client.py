@@ -0,0 +1,220 @@
+"""
+Shared HTTP client for the DUX and GHL APIs: one pooled keep-alive session, a token-bucket
+rate limiter per host, Retry-After handling on 429 and exponential backoff on 5xx errors
+"""
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics, normalize_endpoint
+
+logger = logging.getLogger('DUXScript')
+
+# Default (requests per second, burst) per host. DUX allows roughly one request every
+# few seconds, GHL allows 100 requests per 10 seconds per location.
+DEFAULT_HOST_RATE_LIMITS = {
+    "erp.duxsoftware.com.ar": (0.2, 1),
+    "services.leadconnectorhq.com": (10.0, 10),
+}
+
+# Environment variables overriding the requests per second of each host
+HOST_RATE_LIMIT_ENV = {
+    "erp.duxsoftware.com.ar": "DUX_RATE_LIMIT",
+    "services.leadconnectorhq.com": "GHL_RATE_LIMIT",
+}
+
+# Base URL settings that move each API to another host (e.g. a local stub), its rate limit moves with it
+HOST_BASE_URL_ENV = {
+    "erp.duxsoftware.com.ar": "DUX_API_BASE_URL",
+    "services.leadconnectorhq.com": "GHL_API_BASE_URL",
+}
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# (connect, read) seconds of every request that does not set its own timeout, so a hung
+# connection is retried instead of blocking its worker forever
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` acquisitions per second with bursts of `capacity`
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it. Returns the seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def pause(self, seconds):
+        """
+        Drain the bucket so nobody acquires a token for the next `seconds` (used for Retry-After)
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+            self.updated_at = time.monotonic()
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait for a Retry-After header (delta-seconds or HTTP date), or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class HttpClient:
+    """
+    Pooled requests session shared by every DUX and GHL call
+    """
+
+    def __init__(self, host_rate_limits=None, max_retries=5, backoff_base=1.0, backoff_max=60.0, pool_size=20,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.buckets = {
+            host: TokenBucket(rate, capacity)
+            for host, (rate, capacity) in (host_rate_limits or {}).items()
+            if rate
+        }
+
+    def get_bucket(self, url):
+        return self.buckets.get(urlparse(url).netloc)
+
+    def get_backoff(self, attempt):
+        """
+        Exponential backoff with full jitter for the given retry attempt (starting at 1)
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through the shared session, waiting for the host rate limit and
+        retrying 429 (honoring Retry-After), 5xx, connection errors and timeouts. Requests without
+        a timeout get the client's (connect, read) timeout.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self.get_bucket(url)
+        metrics = get_metrics()
+        parsed_url = urlparse(url)
+        endpoint = normalize_endpoint(parsed_url.path)
+        attempt = 0
+        while True:
+            if bucket:
+                waited = bucket.acquire()
+                if waited:
+                    logger.debug(f"Rate limiter delayed {method} {url} by {waited:.2f}s")
+                    metrics.observe("rate_limit_wait", waited, host=parsed_url.hostname)
+
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe("http_request", time.perf_counter() - start, method=method, host=parsed_url.hostname,
+                                endpoint=endpoint, status="error")
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                metrics.increment("http_retries", host=parsed_url.hostname, reason="connection_error")
+                backoff = self.get_backoff(attempt)
+                logger.warning(f"{method} {url} failed ({str(e)}), retry {attempt}/{self.max_retries} in {backoff:.2f}s")
+                time.sleep(backoff)
+                continue
+
+            metrics.observe("http_request", time.perf_counter() - start, method=method, host=parsed_url.hostname,
+                            endpoint=endpoint, status=response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            attempt += 1
+            metrics.increment("http_retries", host=parsed_url.hostname, reason=response.status_code)
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                backoff = retry_after if retry_after is not None else self.get_backoff(attempt)
+                if bucket:
+                    bucket.pause(backoff)
+            else:
+                backoff = self.get_backoff(attempt)
+            logger.warning(
+                f"{method} {url} returned {response.status_code}, retry {attempt}/{self.max_retries} in {backoff:.2f}s")
+            time.sleep(backoff)
+
+
+def get_host_rate_limits():
+    """
+    Return the rate limits by host (host:port when the base URL has a port), applying DUX_RATE_LIMIT and
+    GHL_RATE_LIMIT overrides and following DUX_API_BASE_URL and GHL_API_BASE_URL to their hosts
+    """
+    host_rate_limits = {}
+    for host, (rate, capacity) in DEFAULT_HOST_RATE_LIMITS.items():
+        rate = float(os.getenv(HOST_RATE_LIMIT_ENV[host], rate))
+        base_url = os.getenv(HOST_BASE_URL_ENV[host])
+        api_host = urlparse(base_url).netloc if base_url else host
+        if api_host in host_rate_limits:
+            logger.warning(f"{HOST_BASE_URL_ENV[host]} points at {api_host} like another API, its rate limit applies to both")
+        host_rate_limits[api_host] = (rate, max(1, capacity))
+    return host_rate_limits
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    Return the process-wide HttpClient, creating it on first use
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient(
+                host_rate_limits=get_host_rate_limits(),
+                max_retries=int(os.getenv("HTTP_MAX_RETRIES", 5)),
+                timeout=(float(os.getenv("HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+                         float(os.getenv("HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT))))
+        return _http_client
@@ -1,13 +1,7 @@
 #!/usr/bin/env python3
-from selenium import webdriver
-from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-import time
+import argparse
+import sys
 import pygsheets
 import os
 from dotenv import load_dotenv
@@ -18,6 +12,22 @@ from email.mime.multipart import MIMEMultipart
 import traceback
 import logging
 from logging.handlers import RotatingFileHandler
+from metrics import get_metrics
+from sheets_writer import create_sheet_writer
+from dux_browser import (
+    CLIENTS_PAGE_URL,
+    SelectorRegistry,
+    StepTimer,
+    create_chrome_driver,
+    extract_table_rows,
+    find_first_table_row,
+    get_wait_timeout,
+    log_page_size_savings,
+    maximize_page_size,
+    open_dux_page,
+    wait_for_ajax_idle,
+    wait_for_table_refresh,
+)
 
 # Configure logging
 def setup_logging():
@@ -96,92 +106,98 @@ def send_error_email(error_message):
         logger.error(f"Failed to send error email: {str(e)}")
         logger.debug(f"SMTP connection details: server={smtp_server}, port={smtp_port}, from={sender_email}, to={receiver_email}")
 
-def main():
+def main(date_from=None, date_to=None):
+    """
+    Export the DUX clients created from date_from to date_to to the Google Sheet. Returns the run status
+    ("success", "no_rows" or "failed").
+    """
     driver = None
+    sheet_writer = None
+    step_timer = StepTimer()
+    run_status = "failed"
     try:
         logger.info("Starting DUX script execution")
-        all_clients_list = []
         logger.debug("Authorizing with pygsheets")
         gc = pygsheets.authorize(service_file="dux-integration-api-crm-3909595c1447.json")
+        logger.debug("Opening Google Sheet 'Clientes DUX - GHL Cloud Server'")
+        wks = gc.open('Clientes DUX - GHL Cloud Server')[0]
+        sheet_writer = create_sheet_writer(wks)
         
         # Configurar Selenium con Chrome
         logger.debug("Initializing Chrome WebDriver")
-        options = Options()
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--window-size=1920,1080')
-        options.add_argument("--disable-blink-features=AutomationControlled")
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-
-        # Paso 1: Ir a la página de login
-        logger.info("Navigating to DUX login page")
-        driver.get("https://erp.duxsoftware.com.ar/")
-
-        # Paso 2: Ingresar credenciales
-        logger.debug("Entering login credentials")
-        driver.find_element(By.ID, "formLogin:inputUsuario").send_keys(os.getenv("DUX_USERNAME"))
-        driver.find_element(By.ID, "formLogin:inputPassword").send_keys(os.getenv("DUX_PASSWORD"), Keys.RETURN)
-
-        logger.debug("Waiting for page load after login")
-        time.sleep(5)
-
-        # Paso 3: Aceptar select de sucursal
-        logger.debug("Selecting branch office")
-        driver.find_element(By.ID, "formInicio:j_idt909").click()
-        time.sleep(5)
-
-        # Paso 4: Navegar a pagina de clientes
+        with step_timer.step("Browser startup"):
+            driver = create_chrome_driver()
+
+        # Paso 1 a 4: Iniciar sesión (o reutilizar la guardada) y navegar a pagina de clientes
         logger.info("Navigating to clients page")
-        driver.get("https://erp.duxsoftware.com.ar/pages/configuracion/cliente/listaClienteBeta.faces")
-        time.sleep(7)
+        selectors = SelectorRegistry(driver)
+        open_dux_page(driver, step_timer, CLIENTS_PAGE_URL, selectors)
+        with step_timer.step("Clients page"):
+            date_filter_menu = selectors.find("date_filter_menu", get_wait_timeout("clients_page"), clickable=True)
+            wait_for_ajax_idle(driver, get_wait_timeout("clients_page"))
 
         # Paso 5 y 6: Configurar fecha
         logger.debug("Configuring date filters")
-        driver.find_element(By.ID, "formCabecera:j_idt1030_label").click()
-        driver.find_element(By.ID, "formCabecera:j_idt1030_3").click()
-
-        time.sleep(10)
+        with step_timer.step("Date filter selection"):
+            date_filter_menu.click()
+            selectors.find("date_filter_range_option", get_wait_timeout("date_filter"), clickable=True).click()
+            wait_for_ajax_idle(driver, get_wait_timeout("date_filter"))
 
         # Paso 7: Escribir fecha y dar enter
+        # Por defecto el día anterior, o el rango pedido con --from/--to
         yesterday = datetime.now() - timedelta(1)
-        yesterday_string_dux = datetime.strftime(yesterday, "%d%m%y")
-        logger.debug(f"Setting date filter to: {yesterday_string_dux}")
-        wait = WebDriverWait(driver, 10)
-        input_element = wait.until(EC.presence_of_element_located((By.ID, "formCabecera:j_idt1040_input")))
-        input_element.click()
-        input_element.send_keys(yesterday_string_dux)
-        input_element = wait.until(EC.presence_of_element_located((By.ID, "formCabecera:j_idt1046_input")))
-        input_element.click()
-        input_element.send_keys(yesterday_string_dux, Keys.RETURN)
-
-        time.sleep(5)
+        date_from = datetime.strptime(date_from, "%Y-%m-%d") if date_from else yesterday
+        date_to = datetime.strptime(date_to, "%Y-%m-%d") if date_to else date_from
+        date_from_dux = datetime.strftime(date_from, "%d%m%y")
+        date_to_dux = datetime.strftime(date_to, "%d%m%y")
+        logger.debug(f"Setting date filter from {date_from_dux} to {date_to_dux}")
+        with step_timer.step("Date filter search"):
+            input_element = selectors.find("date_from_input", get_wait_timeout("date_filter"), clickable=True)
+            input_element.click()
+            input_element.send_keys(date_from_dux)
+            input_element = selectors.find("date_to_input", get_wait_timeout("date_filter"), clickable=True)
+            input_element.click()
+            first_row = find_first_table_row(driver)
+            input_element.send_keys(date_to_dux, Keys.RETURN)
+            wait_for_table_refresh(driver, first_row, get_wait_timeout("table"))
+
+        # Mostrar la mayor cantidad de filas por página para reducir la paginación
+        with step_timer.step("Page size"):
+            page_size = maximize_page_size(driver, selectors, get_wait_timeout("table"))
 
         # Paso 8: Extraer datos de la tabla
         button_next_page_disabled = False
         page_number = 1
+        rows_scraped = 0
 
         logger.info("Starting data extraction from table")
         while not button_next_page_disabled:
             logger.debug(f"Processing page {page_number}")
-            iterate_table(driver, gc, all_clients_list)
-            button_next_page = driver.find_element(By.XPATH, "/html/body/div[2]/div[4]/div/div[2]/div/form/div/div[5]/a[3]")
+            with step_timer.step("Page scrape and sheet update"):
+                rows_scraped += iterate_table(driver, sheet_writer)
+            button_next_page = selectors.find("next_page_button", get_wait_timeout("table"))
             button_next_page_class = button_next_page.get_attribute("class")
             button_next_page_classes = button_next_page_class.split(" ")
             button_next_page_disabled = "ui-state-disabled" in button_next_page_classes
             
             if not button_next_page_disabled:
                 logger.debug(f"Moving to page {page_number + 1}")
-                button_next_page.click()
-                time.sleep(10)
+                with step_timer.step("Next page load"):
+                    first_row = find_first_table_row(driver)
+                    button_next_page.click()
+                    wait_for_table_refresh(driver, first_row, get_wait_timeout("table"))
                 page_number += 1
             else:
                 logger.info("Reached last page of results")
                 button_next_page_disabled = True
 
+        log_page_size_savings(step_timer, page_size, rows_scraped, page_number)
+
+        run_status = "success"
         logger.info("Script execution completed successfully")
 
     except NoRowsFoundException:
+        run_status = "no_rows"
         logger.info("Script finished: No rows found to process")
     except Exception as e:
         error_details = traceback.format_exc()
@@ -189,29 +205,31 @@ def main():
         logger.error(f"Stack trace: {error_details}")
         send_error_email(error_details)
     finally:
+        if sheet_writer:
+            try:
+                with step_timer.step("Sheet flush"):
+                    sheet_writer.flush()
+                sheet_writer.log_summary()
+            except Exception as e:
+                run_status = "failed"
+                logger.error(f"Failed to write buffered rows to Google Sheet: {str(e)}")
         if driver:
             logger.debug("Closing Chrome WebDriver")
             driver.quit()
+        step_timer.log_report()
+        get_metrics().write_reports("dux-sheets", run_status)
+    return run_status
 
 # Add this new custom exception class at the top level of the file, after the imports
 class NoRowsFoundException(Exception):
     """Exception raised when no rows are found to process"""
     pass
 
-def iterate_table(driver, gc, all_clients_list):
+def iterate_table(driver, sheet_writer):
     try:
-        logger.debug("Opening Google Sheet 'Clientes DUX - GHL Cloud Server'")
-        sh = gc.open('Clientes DUX - GHL Cloud Server')
-        wks = sh[0]
-        
         logger.debug("Extracting table data")
-        rows = driver.find_elements(By.TAG_NAME, "tr")
-        rows_processed = 0
-        for row in rows:
-            cols = [col.text for col in row.find_elements(By.TAG_NAME, "td")]
-            if len(cols) == 29:
-                all_clients_list.append(cols)
-                rows_processed += 1
+        page_rows = extract_table_rows(driver)
+        rows_processed = len(page_rows)
         
         logger.info(f"Processed {rows_processed} client rows")
  
@@ -219,9 +237,10 @@ def iterate_table(driver, gc, all_clients_list):
             logger.warning("No rows found to process, stopping execution")
             raise NoRowsFoundException("No rows were found to process in the current page")
             
-        logger.debug("Updating Google Sheet with new data")
-        wks.update_values('A2', all_clients_list)
-        logger.debug("Google Sheet update completed")
+        # Only this page's rows are sent, buffered into large batched writes
+        sheet_writer.append(page_rows)
+        get_metrics().increment("rows_processed", rows_processed, phase="sheet")
+        return rows_processed
         
     except NoRowsFoundException:
         # Just log the warning and re-raise, without sending email
@@ -234,5 +253,27 @@ def iterate_table(driver, gc, all_clients_list):
         send_error_email(error_details)
         raise
 
+def parse_date(value):
+    """
+    argparse type for YYYY-MM-DD dates
+    """
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r}, expected YYYY-MM-DD")
+    return value
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Export DUX clients to Google Sheets")
+    parser.add_argument("--from", dest="date_from", type=parse_date, metavar="YYYY-MM-DD",
+                        help="first client creation date to export (defaults to yesterday)")
+    parser.add_argument("--to", dest="date_to", type=parse_date, metavar="YYYY-MM-DD",
+                        help="last client creation date to export (defaults to --from)")
+    args = parser.parse_args()
+    if args.date_to and not args.date_from:
+        parser.error("--to requires --from")
+    if args.date_to and args.date_to < args.date_from:
+        parser.error("--to must not be before --from")
+    if main(date_from=args.date_from, date_to=args.date_to) == "failed":
+        sys.exit(1)
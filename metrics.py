@@ -0,0 +1,163 @@
+"""
+Run metrics: timers and counters collected during a run, written at the end as a JSON report
+and optionally as a Prometheus textfile (for the node_exporter textfile collector)
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger('DUXScript')
+
+DEFAULT_METRICS_REPORT_DIR = "logs/metrics"
+
+
+def normalize_endpoint(path):
+    """
+    Replace the id segments of a URL path (any segment with a digit) so requests group by endpoint,
+    e.g. /contacts/4FqXw2abc -> /contacts/{id}
+    """
+    return "/".join("{id}" if re.search(r"\d", segment) else segment for segment in path.split("/"))
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    """
+    Render (name, value) pairs as a Prometheus label set
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+def metric_key(name, labels):
+    return name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+
+class RunMetrics:
+    """
+    Thread-safe timers (count, total and max seconds) and counters, each keyed by name and labels
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        # (name, sorted labels) -> [count, total seconds, max seconds]
+        self.timers = {}
+        # (name, sorted labels) -> value
+        self.counters = {}
+
+    def observe(self, name, seconds, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            stats = self.timers.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def increment(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_dict(self, script, status):
+        finished_at = time.time()
+        with self.lock:
+            timers = [
+                {"name": name, "labels": dict(labels), "count": count, "total_seconds": round(total, 6),
+                 "avg_seconds": round(total / count, 6), "max_seconds": round(max_seconds, 6)}
+                for (name, labels), (count, total, max_seconds) in self.timers.items()]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()]
+        return {
+            "script": script,
+            "status": status,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "finished_at": datetime.fromtimestamp(finished_at).isoformat(timespec="seconds"),
+            "duration_seconds": round(finished_at - self.started_at, 3),
+            "timers": timers,
+            "counters": counters,
+        }
+
+    def to_prometheus(self, report):
+        """
+        Render a report from to_dict in the Prometheus text exposition format
+        """
+        run_labels = (("script", report["script"]),)
+        lines = [
+            "# TYPE dux_run_duration_seconds gauge",
+            f"dux_run_duration_seconds{format_labels(run_labels)} {report['duration_seconds']}",
+            "# TYPE dux_run_success gauge",
+            f"dux_run_success{format_labels(run_labels)} {0 if report['status'] == 'failed' else 1}",
+            "# TYPE dux_run_last_timestamp_seconds gauge",
+            f"dux_run_last_timestamp_seconds{format_labels(run_labels)} {int(time.time())}",
+        ]
+        # Samples of a metric family have to be contiguous in the textfile
+        typed = set()
+        for timer in sorted(report["timers"], key=lambda timer: timer["name"]):
+            metric = f"dux_{timer['name']}_seconds"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} summary")
+                typed.add(metric)
+            labels = format_labels(run_labels + tuple(timer["labels"].items()))
+            lines.append(f"{metric}_sum{labels} {timer['total_seconds']}")
+            lines.append(f"{metric}_count{labels} {timer['count']}")
+        for counter in sorted(report["counters"], key=lambda counter: counter["name"]):
+            metric = f"dux_{counter['name']}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{format_labels(run_labels + tuple(counter['labels'].items()))} {counter['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write_reports(self, script, status):
+        """
+        Write the JSON run report to METRICS_REPORT_DIR and, if METRICS_PROMETHEUS_FILE is set, the Prometheus textfile
+        """
+        try:
+            report = self.to_dict(script, status)
+            report_dir = os.getenv("METRICS_REPORT_DIR", DEFAULT_METRICS_REPORT_DIR)
+            if not os.path.exists(report_dir):
+                os.makedirs(report_dir)
+            started_at = datetime.fromtimestamp(self.started_at).strftime("%Y%m%d-%H%M%S")
+            report_path = os.path.join(report_dir, f"{script}-{started_at}.json")
+            with open(report_path, "w", encoding="utf-8") as file:
+                json.dump(report, file, indent=2)
+            logger.info(f"Run report written to {report_path}")
+
+            prometheus_path = os.getenv("METRICS_PROMETHEUS_FILE")
+            if prometheus_path:
+                # Written to a temporary file first so the collector never reads a partial file
+                temporary_path = f"{prometheus_path}.tmp"
+                with open(temporary_path, "w", encoding="utf-8") as file:
+                    file.write(self.to_prometheus(report))
+                os.replace(temporary_path, prometheus_path)
+                logger.debug(f"Prometheus metrics written to {prometheus_path}")
+        except Exception as e:
+            logger.error(f"Failed to write run report: {str(e)}")
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics():
+    """
+    Return the process-wide RunMetrics
+    """
+    return _metrics
@@ -0,0 +1,85 @@
+"""
+Declarative GHL payload mappings compiled once into row -> payload functions, shared by the
+contact upsert (client rows) and the invoice update (DUX invoices)
+"""
+
+
+class Context:
+    """
+    Mapping source read from the context passed along with each row instead of the row itself
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+# Returned by a converter to leave its field out of the payload (e.g. an invalid email)
+SKIP = object()
+
+
+def source_expression(source, columns):
+    """
+    Return the Python expression reading a column name, a tuple of column names or a Context
+    """
+    if isinstance(source, Context):
+        return f"context[{source.name!r}]"
+    if isinstance(source, tuple):
+        return "(" + "".join(source_expression(column, columns) + ", " for column in source) + ")"
+    return f"row[{(columns[source] if columns else source)!r}]"
+
+
+def compile_payload_mapping(spec, columns=None):
+    """
+    Compile a mapping spec into transform(row, context=None) -> payload.
+
+    The spec has "fields" (top-level payload keys) and "custom_fields" (GHL customFields keys), both
+    lists of (target, source) or (target, source, converter). A source is a column name, resolved
+    once to its index through `columns` for list rows or used as the key of dict rows, a tuple of
+    column names (the converter gets the tuple of values) or a Context. Values are sent as they are,
+    None included, unless the converter returns SKIP. Custom fields are always sent as {"key", "field_value"}.
+
+    The spec is turned into the source of a single function building the payload as dict and list
+    literals, so a row costs one call plus one per converter instead of a chain of closures per field.
+    """
+    namespace = {"SKIP": SKIP}
+    lines = ["def transform(row, context=None):"]
+    # Converter results are read into locals first, the ones that may be SKIP are checked afterwards
+    converted = []
+
+    def value_expression(entry):
+        source = source_expression(entry[1], columns)
+        if len(entry) < 3:
+            return source
+        name = f"value_{len(converted)}"
+        namespace[f"convert_{len(converted)}"] = entry[2]
+        lines.append(f"    {name} = convert_{len(converted)}({source})")
+        converted.append(name)
+        return name
+
+    fields = [(entry[0], value_expression(entry)) for entry in spec.get("fields", ())]
+    custom_fields = [(entry[0], value_expression(entry)) for entry in spec.get("custom_fields", ())]
+
+    lines.append("    payload = {")
+    lines += [f"        {target!r}: {value}," for target, value in fields]
+    lines.append("        'customFields': [")
+    lines += [f"            {{'key': {key!r}, 'field_value': {value}}}," for key, value in custom_fields]
+    lines.append("        ],")
+    lines.append("    }")
+    if converted:
+        lines.append(f"    if {' or '.join(f'{name} is SKIP' for name in converted)}:")
+        lines.append("        return drop_skipped(payload)")
+    lines.append("    return payload")
+
+    namespace["drop_skipped"] = drop_skipped
+    exec("\n".join(lines), namespace)
+    return namespace["transform"]
+
+
+def drop_skipped(payload):
+    """
+    Remove the fields and custom fields whose converter returned SKIP, keeping the order of the others
+    """
+    payload = {target: value for target, value in payload.items() if value is not SKIP}
+    payload["customFields"] = [field for field in payload["customFields"] if field["field_value"] is not SKIP]
+    return payload
@@ -0,0 +1,33 @@
+"""
+Generator stages used to stream client rows from the scraper or the DUX API into the sinks
+"""
+import csv
+import logging
+from itertools import islice
+
+logger = logging.getLogger('DUXScript')
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of up to `size` items from an iterable without materializing it
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def spill_pages_to_csv(pages, path):
+    """
+    Pass pages of rows through unchanged while appending every row to a CSV checkpoint file
+    """
+    with open(path, 'a', newline='') as file:
+        writer = csv.writer(file)
+        for page in pages:
+            writer.writerows(page)
+            file.flush()
+            yield page
+    logger.debug(f"Client rows spilled to {path}")
@@ -0,0 +1,197 @@
+"""
+Buffered Google Sheets writers used by main.py, plus an in-memory worksheet to run them offline
+"""
+import logging
+import os
+import re
+
+logger = logging.getLogger('DUXScript')
+
+DEFAULT_BATCH_ROWS = 1000
+
+
+def column_letter(column_number):
+    """
+    Convert a 1-based column number to its A1 letter (1 -> A, 27 -> AA)
+    """
+    letters = ""
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def parse_cell(cell):
+    """
+    Convert an A1 cell reference to 1-based (row, column)
+    """
+    match = re.fullmatch(r"([A-Za-z]+)(\d+)", cell)
+    if not match:
+        raise ValueError(f"Invalid cell reference: {cell}")
+    column_number = 0
+    for letter in match.group(1).upper():
+        column_number = column_number * 26 + ord(letter) - ord("A") + 1
+    return int(match.group(2)), column_number
+
+
+class SheetWriter:
+    """
+    Appends rows to a worksheet opened once, buffering them and writing each batch with a single request
+    """
+
+    def __init__(self, worksheet, start_row=2, batch_rows=None):
+        self.worksheet = worksheet
+        self.next_row = start_row
+        self.batch_rows = batch_rows or int(os.getenv("SHEETS_BATCH_ROWS", DEFAULT_BATCH_ROWS))
+        self.buffer = []
+        self.rows_written = 0
+        self.requests = 0
+
+    def append(self, rows):
+        """
+        Buffer rows, flushing whenever a full batch is available
+        """
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every buffered row in one update_values request
+        """
+        if not self.buffer:
+            return
+        logger.debug(f"Writing {len(self.buffer)} rows to Google Sheet starting at row {self.next_row}")
+        self.worksheet.update_values(f"A{self.next_row}", self.buffer)
+        self.next_row += len(self.buffer)
+        self.rows_written += len(self.buffer)
+        self.requests += 1
+        self.buffer = []
+
+    def log_summary(self):
+        logger.info(f"Google Sheet writer. Rows written: {self.rows_written}, Write requests: {self.requests}")
+
+
+class SheetUpsertWriter:
+    """
+    Upserts rows keyed by the DUX client id: the id column is read once into an index of
+    client id -> row number, existing clients are rewritten in place and new ones appended.
+    Buffered rows are written with one batched request covering every contiguous block.
+    """
+
+    def __init__(self, worksheet, id_column=3, header_rows=1, batch_rows=None):
+        self.worksheet = worksheet
+        self.id_column = id_column
+        self.batch_rows = batch_rows or int(os.getenv("SHEETS_BATCH_ROWS", DEFAULT_BATCH_ROWS))
+        # row number -> row values waiting to be written
+        self.pending = {}
+        self.rows_updated = 0
+        self.rows_appended = 0
+        self.requests = 0
+
+        ids = worksheet.get_col(id_column, include_tailing_empty=False)
+        self.index = {}
+        for row_number, client_id in enumerate(ids, start=1):
+            if row_number > header_rows and client_id:
+                self.index[str(client_id)] = row_number
+        self.next_row = max(len(ids), header_rows) + 1
+        logger.debug(f"Indexed {len(self.index)} clients from the Google Sheet, next free row {self.next_row}")
+
+    def append(self, rows):
+        """
+        Queue rows for an in-place update or an append, flushing whenever a full batch is available
+        """
+        for row in rows:
+            client_id = str(row[self.id_column - 1])
+            row_number = self.index.get(client_id)
+            if row_number is None:
+                row_number = self.next_row
+                self.next_row += 1
+                self.index[client_id] = row_number
+                self.rows_appended += 1
+            else:
+                self.rows_updated += 1
+            self.pending[row_number] = row
+        if len(self.pending) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every pending row, one range per block of consecutive rows, in a single batch request
+        """
+        if not self.pending:
+            return
+        ranges = []
+        values = []
+        block = []
+        for row_number in sorted(self.pending):
+            if block and row_number != block[-1][0] + 1:
+                self.add_block(block, ranges, values)
+                block = []
+            block.append((row_number, self.pending[row_number]))
+        self.add_block(block, ranges, values)
+
+        logger.debug(f"Writing {len(self.pending)} rows to Google Sheet in {len(ranges)} ranges")
+        self.worksheet.update_values_batch(ranges, values)
+        self.requests += 1
+        self.pending = {}
+
+    @staticmethod
+    def add_block(block, ranges, values):
+        width = max(len(row) for _, row in block)
+        ranges.append(f"A{block[0][0]}:{column_letter(width)}{block[-1][0]}")
+        values.append([row for _, row in block])
+
+    def log_summary(self):
+        logger.info(
+            f"Google Sheet upsert. Rows updated: {self.rows_updated}, Rows appended: {self.rows_appended}, "
+            f"Write requests: {self.requests}")
+
+
+def create_sheet_writer(worksheet):
+    """
+    Return the writer selected by SHEETS_WRITE_MODE: overwrite (default, rows written from A2 down) or upsert
+    """
+    write_mode = os.getenv("SHEETS_WRITE_MODE", "overwrite").lower()
+    if write_mode == "upsert":
+        return SheetUpsertWriter(worksheet)
+    return SheetWriter(worksheet)
+
+
+class FakeWorksheet:
+    """
+    In-memory stand-in for a pygsheets Worksheet implementing the calls made by the sheet writers
+    """
+
+    def __init__(self, rows=None):
+        self.rows = [list(row) for row in rows or []]
+        self.requests = 0
+        self.cells_written = 0
+
+    def update_values(self, crange=None, values=None, **kwargs):
+        self.requests += 1
+        self.write_range(crange, values)
+
+    def update_values_batch(self, ranges, values, **kwargs):
+        self.requests += 1
+        for crange, range_values in zip(ranges, values):
+            self.write_range(crange, range_values)
+
+    def write_range(self, crange, values):
+        start_row, start_column = parse_cell(crange.split(":")[0])
+        for offset, values_row in enumerate(values):
+            row_index = start_row - 1 + offset
+            while len(self.rows) <= row_index:
+                self.rows.append([])
+            row = self.rows[row_index]
+            while len(row) < start_column - 1 + len(values_row):
+                row.append("")
+            row[start_column - 1:start_column - 1 + len(values_row)] = values_row
+            self.cells_written += len(values_row)
+
+    def get_col(self, col, include_tailing_empty=True, **kwargs):
+        column = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        if not include_tailing_empty:
+            while column and not column[-1]:
+                column.pop()
+        return column
@@ -0,0 +1,406 @@
+"""
+Local SQLite state kept between runs
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('DUXScript')
+
+DEFAULT_STATE_DB = "state/dux_state.sqlite3"
+
+
+def get_state_db_path():
+    """
+    Return the path of the state database, overridable with DUX_STATE_DB
+    """
+    return os.getenv("DUX_STATE_DB", DEFAULT_STATE_DB)
+
+
+def connect_state_db(path=None):
+    """
+    Open the state database, creating its directory if needed. The connection is shared between threads,
+    callers serialize access with their own lock.
+    """
+    path = path or get_state_db_path()
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+class ContactIdCache:
+    """
+    Persistent mapping from DUX client id to GHL contact id with TTL and size-based eviction
+    """
+
+    def __init__(self, path=None, ttl_seconds=30 * 24 * 3600, max_entries=100000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS contact_ids ("
+                "id_cliente_dux TEXT PRIMARY KEY, contact_id TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self.evict()
+
+    def get(self, id_cliente_dux):
+        """
+        Return the cached GHL contact id, or None on a miss or an expired entry
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT contact_id, updated_at FROM contact_ids WHERE id_cliente_dux = ?",
+                (str(id_cliente_dux),)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def set(self, id_cliente_dux, contact_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO contact_ids (id_cliente_dux, contact_id, updated_at) VALUES (?, ?, ?)",
+                (str(id_cliente_dux), str(contact_id), time.time()))
+
+    def delete(self, id_cliente_dux):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM contact_ids WHERE id_cliente_dux = ?", (str(id_cliente_dux),))
+
+    def evict(self):
+        """
+        Drop expired entries and, above max_entries, the least recently updated ones
+        """
+        with self.lock, self.connection:
+            expired = self.connection.execute(
+                "DELETE FROM contact_ids WHERE updated_at < ?", (time.time() - self.ttl_seconds,)).rowcount
+            overflow = self.connection.execute(
+                "DELETE FROM contact_ids WHERE id_cliente_dux IN ("
+                "SELECT id_cliente_dux FROM contact_ids ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+        if expired or overflow:
+            logger.debug(f"Contact id cache evicted {expired} expired and {overflow} overflow entries")
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        logger.info(f"Contact id cache. Hits: {self.hits}, Misses: {self.misses}, Hit rate: {hit_rate:.1f}%")
+
+
+_contact_cache = None
+_contact_cache_lock = threading.Lock()
+
+
+def get_contact_cache():
+    """
+    Return the process-wide ContactIdCache, configured with CONTACT_CACHE_TTL_DAYS and CONTACT_CACHE_MAX_ENTRIES
+    """
+    global _contact_cache
+    with _contact_cache_lock:
+        if _contact_cache is None:
+            _contact_cache = ContactIdCache(
+                ttl_seconds=float(os.getenv("CONTACT_CACHE_TTL_DAYS", 30)) * 24 * 3600,
+                max_entries=int(os.getenv("CONTACT_CACHE_MAX_ENTRIES", 100000)))
+        return _contact_cache
+
+
+class GhlContactIndex:
+    """
+    In-memory index of the GHL contacts of a location by DUX client id, persisted with the latest
+    dateUpdated seen so the next preload only has to fetch the contacts changed since then
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        # Replaced as a whole by load and update, so readers never see a partially built index
+        self.contacts = {}
+        self.location_id = None
+        # True once a preload finished, a DUX client id missing from the index then has no contact
+        self.complete = False
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS ghl_contacts ("
+                "location_id TEXT NOT NULL, id_cliente_dux TEXT NOT NULL, contact_id TEXT NOT NULL, "
+                "date_updated TEXT, PRIMARY KEY (location_id, id_cliente_dux))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS ghl_contact_sync ("
+                "location_id TEXT PRIMARY KEY, watermark TEXT, full_refresh_at REAL NOT NULL)")
+
+    def load(self, location_id):
+        """
+        Load the persisted index of a location into memory. Returns (watermark, full_refresh_at),
+        both None if the location was never preloaded.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id_cliente_dux, contact_id FROM ghl_contacts WHERE location_id = ?",
+                (location_id,)).fetchall()
+            sync = self.connection.execute(
+                "SELECT watermark, full_refresh_at FROM ghl_contact_sync WHERE location_id = ?",
+                (location_id,)).fetchone()
+            self.location_id = location_id
+            self.contacts = dict(rows)
+        return sync if sync is not None else (None, None)
+
+    def update(self, location_id, contacts, watermark, full_refresh=False):
+        """
+        Store (id_cliente_dux, contact_id, date_updated) entries fetched by a preload and move the watermark.
+        A full refresh replaces the location's index, dropping contacts deleted in GHL.
+        """
+        with self.lock, self.connection:
+            index = {} if full_refresh else dict(self.contacts)
+            for id_cliente_dux, contact_id, _ in contacts:
+                index[str(id_cliente_dux)] = contact_id
+            if full_refresh:
+                self.connection.execute("DELETE FROM ghl_contacts WHERE location_id = ?", (location_id,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ghl_contacts (location_id, id_cliente_dux, contact_id, date_updated) "
+                "VALUES (?, ?, ?, ?)",
+                [(location_id, str(id_cliente_dux), contact_id, date_updated)
+                 for id_cliente_dux, contact_id, date_updated in contacts])
+            if full_refresh:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO ghl_contact_sync (location_id, watermark, full_refresh_at) "
+                    "VALUES (?, ?, ?)", (location_id, watermark, time.time()))
+            else:
+                self.connection.execute(
+                    "UPDATE ghl_contact_sync SET watermark = ? WHERE location_id = ?", (watermark, location_id))
+            self.location_id = location_id
+            self.contacts = index
+            self.complete = True
+
+    def get(self, id_cliente_dux):
+        return self.contacts.get(str(id_cliente_dux))
+
+    def delete(self, location_id, id_cliente_dux):
+        with self.lock, self.connection:
+            if location_id == self.location_id:
+                self.contacts.pop(str(id_cliente_dux), None)
+            self.connection.execute(
+                "DELETE FROM ghl_contacts WHERE location_id = ? AND id_cliente_dux = ?",
+                (location_id, str(id_cliente_dux)))
+
+
+_contact_index = None
+_contact_index_lock = threading.Lock()
+
+
+def get_contact_index():
+    """
+    Return the process-wide GhlContactIndex
+    """
+    global _contact_index
+    with _contact_index_lock:
+        if _contact_index is None:
+            _contact_index = GhlContactIndex()
+        return _contact_index
+
+
+def hash_payload(payload):
+    """
+    Return a stable SHA-256 hash of a JSON payload (key order and whitespace independent)
+    """
+    serialized = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class PayloadHashStore:
+    """
+    Hash of the last payload successfully sent to GHL per (kind, key), used to skip no-op writes
+    """
+
+    def __init__(self, path=None, force=False):
+        self.force = force
+        self.lock = threading.Lock()
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS payload_hashes ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, payload_hash TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (kind, key))")
+
+    def is_unchanged(self, kind, key, payload_hash):
+        """
+        True if the payload matches the last one sent for this key (always False when forcing writes)
+        """
+        if self.force:
+            return False
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT payload_hash FROM payload_hashes WHERE kind = ? AND key = ?", (kind, str(key))).fetchone()
+        return row is not None and row[0] == payload_hash
+
+    def record(self, kind, key, payload_hash):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO payload_hashes (kind, key, payload_hash, updated_at) VALUES (?, ?, ?, ?)",
+                (kind, str(key), payload_hash, time.time()))
+
+
+_payload_hash_store = None
+_payload_hash_store_lock = threading.Lock()
+
+
+def get_payload_hash_store():
+    """
+    Return the process-wide PayloadHashStore
+    """
+    global _payload_hash_store
+    with _payload_hash_store_lock:
+        if _payload_hash_store is None:
+            _payload_hash_store = PayloadHashStore()
+        return _payload_hash_store
+
+
+class LatestInvoiceStore:
+    """
+    Sort key of the last invoice written to each client's GHL contact, so an invoice older than the
+    one the contact already holds (an earlier backfill window finishing late, a backfill after a daily
+    run) is not written over it
+    """
+
+    def __init__(self, path=None, lock_stripes=64):
+        self.lock = threading.Lock()
+        # Held around the check, the PUT and the record of a client so two windows can't interleave them
+        self.client_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS latest_invoices ("
+                "id_cliente TEXT PRIMARY KEY, sort_key TEXT NOT NULL, invoice_id TEXT NOT NULL, "
+                "updated_at REAL NOT NULL)")
+
+    def client_lock(self, id_cliente):
+        return self.client_locks[hash(str(id_cliente)) % len(self.client_locks)]
+
+    def is_older(self, id_cliente, sort_key):
+        """
+        True if the client's contact already holds an invoice newer than sort_key
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sort_key FROM latest_invoices WHERE id_cliente = ?", (str(id_cliente),)).fetchone()
+        return row is not None and sort_key < row[0]
+
+    def record(self, id_cliente, sort_key, invoice_id):
+        """
+        Record an invoice written to the client's contact, keeping the newest one
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO latest_invoices (id_cliente, sort_key, invoice_id, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id_cliente) DO UPDATE SET sort_key = excluded.sort_key, "
+                "invoice_id = excluded.invoice_id, updated_at = excluded.updated_at "
+                "WHERE excluded.sort_key >= latest_invoices.sort_key",
+                (str(id_cliente), sort_key, str(invoice_id), time.time()))
+
+    def delete(self, id_cliente):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM latest_invoices WHERE id_cliente = ?", (str(id_cliente),))
+
+
+_latest_invoice_store = None
+_latest_invoice_store_lock = threading.Lock()
+
+
+def get_latest_invoice_store():
+    """
+    Return the process-wide LatestInvoiceStore
+    """
+    global _latest_invoice_store
+    with _latest_invoice_store_lock:
+        if _latest_invoice_store is None:
+            _latest_invoice_store = LatestInvoiceStore()
+        return _latest_invoice_store
+
+
+class BackfillWindowStore:
+    """
+    Date windows completed by backfill runs, so reprocessing a range skips the windows already done
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS backfill_windows ("
+                "date_from TEXT NOT NULL, date_to TEXT NOT NULL, completed_at REAL NOT NULL, "
+                "PRIMARY KEY (date_from, date_to))")
+
+    def is_done(self, date_from, date_to):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM backfill_windows WHERE date_from = ? AND date_to = ?", (date_from, date_to)).fetchone()
+        return row is not None
+
+    def mark_done(self, date_from, date_to):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO backfill_windows (date_from, date_to, completed_at) VALUES (?, ?, ?)",
+                (date_from, date_to, time.time()))
+
+
+class BranchCatalogCache:
+    """
+    DUX branch offices (id -> name) per company, cached so warm runs skip the /sucursales request
+    """
+
+    def __init__(self, path=None, ttl_seconds=24 * 3600):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.connection = connect_state_db(path)
+        with self.lock, self.connection:
+            # id has no declared type so branch ids keep the type the API returned
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS branches ("
+                "id_empresa TEXT NOT NULL, position INTEGER NOT NULL, id NOT NULL, sucursal TEXT, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (id_empresa, position))")
+
+    def get(self, id_empresa):
+        """
+        Return the cached {id: name} catalog in API order, or None when missing or expired
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, sucursal, updated_at FROM branches WHERE id_empresa = ? ORDER BY position",
+                (str(id_empresa),)).fetchall()
+        if not rows or time.time() - min(row[2] for row in rows) > self.ttl_seconds:
+            return None
+        return {row[0]: row[1] for row in rows}
+
+    def set(self, id_empresa, branches):
+        updated_at = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM branches WHERE id_empresa = ?", (str(id_empresa),))
+            self.connection.executemany(
+                "INSERT INTO branches (id_empresa, position, id, sucursal, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(str(id_empresa), position, id_branch, sucursal, updated_at)
+                 for position, (id_branch, sucursal) in enumerate(branches.items())])
+
+
+_branch_cache = None
+_branch_cache_lock = threading.Lock()
+
+
+def get_branch_cache():
+    """
+    Return the process-wide BranchCatalogCache, configured with BRANCH_CACHE_TTL_HOURS
+    """
+    global _branch_cache
+    with _branch_cache_lock:
+        if _branch_cache is None:
+            _branch_cache = BranchCatalogCache(
+                ttl_seconds=float(os.getenv("BRANCH_CACHE_TTL_HOURS", 24)) * 3600)
+        return _branch_cache